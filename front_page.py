@@ -1,25 +1,58 @@
 import streamlit as st
 import os
+import logging
 import io
 import sys
-from contextlib import redirect_stdout
+import ctypes
+import threading
+import time
+import uuid
+from concurrent.futures import as_completed
+import hashlib
 import platform
 import pandas as pd
 from datetime import datetime
 from dotenv import load_dotenv
-import zipfile
-import matplotlib.pyplot as plt # 確保 matplotlib 被導入
-import seaborn as sns # 引入 seaborn 提供更多繪圖選擇，但不強制使用
 
 # 自訂模組 (請確保 config/prompts.py 裡面沒有 circular import)
-from config.prompts import create_system_prompt
-from utils.data_loader import load_all_data
-from utils.ai_client import initialize_client
+from config.prompts import (
+    create_system_prompt,
+    CLARIFICATION_PROMPT_TEMPLATE,
+    ENHANCEMENT_SYSTEM_PROMPT,
+    BEST_PRACTICES_APPENDIX,
+    REFLECTION_PROMPT_TEMPLATE,
+    INSIGHT_SYSTEM_PROMPT,
+    INSIGHT_PROMPT_TEMPLATE,
+)
+from utils.data_loader import load_all_data, load_player_matches, scope_to_players, find_mentioned_players
+from utils.ai_client import initialize_client, cached_chat_completion, parse_json_response
 from utils.data_processor import process_badminton_data
+from utils.code_executor import (
+    extract_code,
+    strip_code_blocks,
+    compile_code,
+    summarize_namespace,
+    get_summary_table,
+    has_empty_frames,
+    frame_to_prompt_csv,
+    FigureTracker,
+    capture_stdout,
+)
+from utils.token_budget import trim_messages, truncate_text
+from utils.disk_cache import CODE_CACHE_PATH, make_cache_key, normalize_prompt, cache_get, cache_set
+from utils.semantic_cache import get_semantic_cache, embed_text, question_entities, has_unresolved_names
+from utils.session_store import save_chart_png, read_chart_png, cleanup_expired_sessions
 
 # --- 初始設定與環境變數載入 ---
 load_dotenv()
 
+# 啟用 pandas Copy-on-Write：快取的 df 由所有 session 共用，AI 程式碼對淺複製的寫入不會回寫到共用資料
+# (pandas 3 起預設且固定啟用，該選項已棄用，設定會發出警告)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+log = logging.getLogger("badminton_ai")
+
 # 設定頁面
 st.set_page_config(
     page_title="羽球 AI 數據分析師",
@@ -27,57 +60,486 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- 輔助函數：非同步日誌 ---
+# 診斷訊息經由 QueueHandler 寫入記憶體佇列，再由背景執行緒輸出到 stderr，
+# 避免雲端部署時 stdout flush 阻塞分析流程。每個 process 只設定一次。
+@st.cache_resource
+def setup_logging():
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+
+    log.addHandler(QueueHandler(log_queue))
+    log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    log.propagate = False
+    return listener
+
+setup_logging()
+
+# --- 輔助函數：清理閒置的圖表檔案 ---
+# 每個 process 啟動時執行一次，刪除超過 TTL 未更新的 session 圖表目錄
+@st.cache_resource
+def cleanup_session_files():
+    removed = cleanup_expired_sessions()
+    if removed:
+        log.info("Removed %d expired session chart directories", removed)
+    return removed
+
+cleanup_session_files()
+
 # --- 輔助函數：安全讀取 API Key ---
 def get_api_key(key_name):
     """
     從環境變數或 Streamlit Secrets 安全讀取 API Key。
+    結果依 key_name 存於 session_state，之後的重新執行不再查詢 st.secrets。
     """
+    key_cache = st.session_state.setdefault("_api_key_cache", {})
+    if key_name in key_cache:
+        return key_cache[key_name]
+
     # 優先從 .env 環境變數讀取
-    env_value = os.getenv(key_name, "")
-    if env_value:
-        return env_value
+    value = os.getenv(key_name, "")
 
     # 如果環境變數沒有，嘗試從 Streamlit Secrets 讀取
-    try:
-        if hasattr(st, 'secrets') and st.secrets:
-            return st.secrets.get(key_name, "")
-    except Exception:
-        pass
+    if not value:
+        try:
+            if hasattr(st, 'secrets') and st.secrets:
+                value = st.secrets.get(key_name, "")
+        except Exception:
+            pass
 
-    return ""
+    key_cache[key_name] = value
+    return value
 
 # --- 輔助函數：讀取場地定義 ---
-@st.cache_data
-def load_court_info():
+COURT_INFO_PATH = "court_place.txt"
+
+
+@st.cache_resource(show_spinner=False)
+def load_court_info(mtime):
+    """
+    讀取場地定義檔 (以檔案修改時間為快取 key，檔案更新後自動重新讀取)
+
+    Args:
+        mtime: court_place.txt 的修改時間
+
+    Returns:
+        str: 場地定義內容，讀取失敗時回傳空字串
+    """
+    try:
+        with open(COURT_INFO_PATH, "r", encoding="utf-8") as f:
+            info = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        log.warning("Failed to load court info: %s", e)
+        return ""
+    log.info("Court info loaded successfully")
+    return info
+
+
+def get_court_info():
+    """取得場地定義，檔案不存在時回傳空字串"""
     try:
-        with open("court_place.txt", "r", encoding="utf-8") as f:
-            return f.read()
-        print("Court info loaded successfully")
-    except:
+        mtime = os.path.getmtime(COURT_INFO_PATH)
+    except OSError:
         return ""
+    return load_court_info(mtime)
+
+
+court_place_info = get_court_info()
 
-court_place_info = load_court_info()
+# 圖表預覽解析度：頁面與歷史紀錄顯示用，以螢幕檢視為主
+PREVIEW_DPI = 100
+# 下載按鈕與 ZIP 報告使用的高解析度 DPI
+EXPORT_DPI = 300
+# PNG 編碼參數 (Pillow)：圖表只供顯示與下載，不會再加工，以編碼速度優先；
+# zlib 等級 1 的檔案只比預設 (6) 大約一成，編碼快數倍。optimize 會額外多跑一輪壓縮搜尋，明確關閉
+PNG_PIL_KWARGS = {"compress_level": 1, "optimize": False}
+
+# --- 輔助函數：延遲匯入模組 ---
+class LazyModule:
+    """
+    第一次存取屬性時才匯入的模組代理
+
+    seaborn 匯入時會連帶載入 scipy 並註冊樣式，只畫 matplotlib 圖表的分析不必付出這個成本。
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            import importlib
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# --- 輔助函數：延遲載入繪圖套件 ---
+# matplotlib / seaborn 匯入成本高 (seaborn 會連帶載入 scipy)，且只有執行 AI 程式碼時才需要。
+# Streamlit 每次互動都會重跑整個腳本，因此改為第一次使用時才匯入，並以 cache_resource 保留。
+@st.cache_resource
+def load_plotting_libs():
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    import matplotlib.pyplot as plt
+    # AI 程式碼常一次開多張圖表，不需要「開啟過多圖表」警告 (圖表由 FigureTracker 負責關閉)
+    plt.rcParams["figure.max_open_warning"] = 0
+    # 線條路徑簡化到最大容許值，資料點很多的折線圖繪製更快
+    plt.rcParams["path.simplify_threshold"] = 1.0
+    return plt, LazyModule("seaborn")
+
+# --- 輔助函數：限時執行 AI 程式碼 ---
+# AI 程式碼在背景執行緒執行，主流程最多等待 EXEC_TIMEOUT_SECONDS 秒，
+# 避免一段失控的迴圈卡住整個分析流程；逾時直接結束本次分析 (不交由 AI 修正重跑)。
+EXEC_TIMEOUT_SECONDS = 60
+# 等待執行期間每隔幾秒回報一次進度 (更新狀態列)
+EXEC_POLL_SECONDS = 1.0
+
+class CodeExecutionTimeout(Exception):
+    """AI 程式碼執行逾時 (與程式碼本身拋出的 TimeoutError 區分，呼叫端據此結束分析而不重試)"""
+
+
+class _ExecutionAbandoned(BaseException):
+    # 注入逾時執行緒的例外；繼承 BaseException，AI 程式碼中的 except Exception 攔不到
+    pass
+
+
+def _interrupt_thread(thread):
+    """
+    要求執行緒在下一個 Python bytecode 拋出 _ExecutionAbandoned
+
+    Python 執行緒無法被強制終止，這是盡力而為：純 Python 迴圈會因此停止，
+    但卡在單一 C 呼叫 (如大型 pandas 運算) 時要等該呼叫返回才會生效。
+    """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), ctypes.py_object(_ExecutionAbandoned))
+
+def run_generated_code(code, exec_globals, figure_tracker, on_wait=None):
+    """
+    執行 AI 程式碼並回傳 stdout
+
+    每次執行使用獨立的 daemon 執行緒，不佔用共用的執行緒池，不會讓其他 session 的執行排隊等待。
+    逾時時對執行緒注入例外使其盡快停止，停止後關閉它開啟的圖表。
+    stdout 只擷取本執行緒的輸出，不替換整個 process 的 sys.stdout。
+
+    Args:
+        code: AI 程式碼
+        exec_globals: exec() 使用的 globals dict
+        figure_tracker: 記錄本次執行開啟圖表的 FigureTracker (每次執行使用新的 tracker)
+        on_wait: 執行中每 EXEC_POLL_SECONDS 秒呼叫一次，參數為已執行秒數 (如更新狀態列)
+
+    Raises:
+        CodeExecutionTimeout: 執行超過 EXEC_TIMEOUT_SECONDS 秒 (呼叫端不應在此時重試)
+    """
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    result = {}
+    abandoned = threading.Event()
+
+    def _run():
+        # 讓程式碼中的 st.* 呼叫能找到目前的 session
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            with figure_tracker.track(), capture_stdout() as f:
+                exec(compile_code(code), exec_globals)
+            result["stdout"] = f.getvalue()
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            if abandoned.is_set():
+                # 已逾時，沒有人會使用這次執行的圖表
+                figure_tracker.close()
+
+    thread = threading.Thread(target=_run, name="ai_exec", daemon=True)
+    thread.start()
+    start = time.monotonic()
+    while True:
+        thread.join(EXEC_POLL_SECONDS)
+        if not thread.is_alive():
+            break
+        elapsed = time.monotonic() - start
+        if elapsed >= EXEC_TIMEOUT_SECONDS:
+            abandoned.set()
+            _interrupt_thread(thread)
+            raise CodeExecutionTimeout(f"程式執行超過 {EXEC_TIMEOUT_SECONDS} 秒，已停止本次分析。請改用向量化運算或縮小資料範圍後重新提問。")
+        if on_wait is not None:
+            on_wait(elapsed)
+
+    if "error" in result:
+        raise result["error"]
+    return result["stdout"]
+
+# --- 輔助函數：節流串流畫面更新 ---
+# 串流時每個 token 都更新一次畫面會送出大量前端訊息，改為累積片段，最多每 STREAM_REFRESH_SECONDS 秒重畫一次
+STREAM_REFRESH_SECONDS = 0.05
+
+class ThrottledWriter:
+    """
+    累積串流片段並以固定頻率更新畫面
+
+    Args:
+        render: 接收目前完整文字的更新函數 (如 placeholder.markdown)
+        interval: 兩次更新之間的最短秒數
+    """
+
+    def __init__(self, render, interval=STREAM_REFRESH_SECONDS):
+        self.render = render
+        self.interval = interval
+        self._parts = []
+        self._last = 0.0
+
+    def push(self, delta):
+        """加入一個片段，距上次更新超過 interval 才重畫"""
+        self._parts.append(delta)
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self.render("".join(self._parts))
+            self._last = now
+
+    def text(self):
+        """目前累積的完整文字"""
+        return "".join(self._parts)
+
+    def flush(self):
+        """以完整文字做最後一次更新並回傳"""
+        text = self.text()
+        self.render(text)
+        return text
+
+# --- 輔助函數：背景輸出圖表 PNG ---
+# PNG 編碼是純 CPU 工作 (Agg 在編碼時會釋放 GIL)，
+# 交給背景執行緒處理，多張圖表可同時編碼，並與 Step 6 的洞察 LLM 呼叫重疊進行。
+@st.cache_resource
+def get_render_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    # 多張圖表可同時編碼，最多 4 條執行緒 (不超過 CPU 核心數)
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="png_render")
+
+# 接續前文時，較早的 AI 回覆 (最近一則以外) 只保留前幾個字元作為摘要
+HISTORY_GIST_CHARS = 400
+
+# Step 3 修正程式碼時同時送出的請求 temperature (每個值一個請求)
+CORRECTION_TEMPERATURES = (0.2, 0.5)
+
+# --- 輔助函數：背景 LLM 呼叫 ---
+# 互不相依的 LLM 請求 (如 Step 0 與 Step 1) 可同時送出，總等待時間取兩者較長者而非相加
+@st.cache_resource
+def get_llm_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="llm_call")
+
+# 每條編碼執行緒重複使用同一個 BytesIO，避免每張圖表重新配置緩衝區
+_render_local = threading.local()
+
+def render_png(fig, dpi=PREVIEW_DPI):
+    buf = getattr(_render_local, "buf", None)
+    if buf is None:
+        buf = _render_local.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight", pil_kwargs=PNG_PIL_KWARGS)
+    return buf.getvalue()
+
+def render_chart_pngs(fig):
+    """
+    輸出圖表的顯示用預覽與下載用高解析度 PNG
+
+    同一張 Figure 不可由多條執行緒同時繪製，因此兩種解析度在同一個工作中依序輸出。
+
+    Returns:
+        tuple[bytes, bytes]: (PREVIEW_DPI 預覽, EXPORT_DPI 高解析度)
+    """
+    return render_png(fig), render_png(fig, dpi=EXPORT_DPI)
+
+def fill_chart_slots(pending_charts, wait=False):
+    """
+    將已完成編碼的圖表與下載按鈕填入預留的位置
+
+    Args:
+        pending_charts: [(圖表序號, 圖片位置, 按鈕位置, render_chart_pngs future)]，已填入的項目會從列表移除
+        wait: True 時等待所有圖表編碼完成；False 時只填入已完成的圖表
+    """
+    for item in list(pending_charts):
+        i, image_slot, button_slot, png_future = item
+        if not wait and not png_future.done():
+            continue
+        preview_png, export_png = png_future.result()
+        image_slot.image(preview_png, use_container_width=True)
+        button_slot.download_button(
+            f"📥 下載圖表 {i+1}",
+            data=export_png,
+            file_name=f"羽球分析_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}.png",
+            mime="image/png",
+            key=f"download_new_{i}"
+        )
+        pending_charts.remove(item)
+
+# --- 輔助函數：分析報告 ZIP ---
+# 角色 -> (圖示, 報告標題)
+ROLE_META = {
+    "user": ("👤", "使用者提問"),
+    "assistant": ("🤖", "AI 分析師回覆"),
+}
+
+def get_message_pngs(message):
+    """
+    讀取訊息圖表的 PNG bytes (建立訊息時已寫入磁碟的 "preview_paths" 與 "figure_paths")
+
+    Returns:
+        list[tuple[bytes, bytes]]: 每張圖表的 (顯示用預覽, 下載用高解析度) PNG；
+        沒有預覽檔的舊訊息兩者相同，已被閒置清理刪除的檔案會略過
+    """
+    export_paths = message.get("figure_paths", ())
+    preview_paths = message.get("preview_paths") or export_paths
+    charts = []
+    for preview_path, export_path in zip(preview_paths, export_paths):
+        export_png = read_chart_png(export_path)
+        if export_png is None:
+            continue
+        preview_png = export_png if preview_path == export_path else read_chart_png(preview_path)
+        charts.append((preview_png or export_png, export_png))
+    return charts
+
+def get_messages_signature(messages):
+    """
+    以 (角色, 內容, 圖表路徑) 組成對話紀錄的簽章，作為 ZIP 快取的 key
+    """
+    return tuple(
+        (m["role"], m["content"], tuple(m.get("figure_paths", ())))
+        for m in messages
+    )
+
+def format_message_md(message):
+    """
+    將單則訊息轉為報告用的 Markdown 段落 (程式碼區塊保留，圖表以檔名引用)
+
+    Returns:
+        str: Markdown 段落
+    """
+    role_emoji, role_title = ROLE_META[message["role"]]
+    parts = [f"### {role_emoji} {role_title}\n{message['content'].strip()}\n\n"]
+    for chart_idx, path in enumerate(message.get("figure_paths", ()), start=1):
+        parts.append(f"![產生的圖表 {chart_idx}]({os.path.basename(path)})\n\n")
+    parts.append("---\n\n")
+    return "".join(parts)
+
+def append_message(message):
+    """新增對話訊息，同時預先產生報告用的 Markdown 段落，打包 ZIP 時只需串接"""
+    message["_md"] = format_message_md(message)
+    st.session_state.messages.append(message)
+
+def build_report_zip(messages):
+    """
+    將對話紀錄與圖表打包成 ZIP。
+    結果由 render_report_export 依對話簽章存於 session_state (每個 session 只保留最新一份)。
+    """
+    import zipfile
+
+    zip_buffer = io.BytesIO()
+    # PNG 本身已是 DEFLATE 壓縮，再壓一次只浪費 CPU，因此預設以 ZIP_STORED 存放；
+    # 只有文字報告 (.md) 另外以 DEFLATED 壓縮
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zip_f:
+        header = (
+            f"# 🏸 羽球 AI 數據分析師 - 分析報告\n"
+            f"**儲存時間:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n---\n\n"
+        )
+        # 各訊息的 Markdown 已在新增訊息時產生，這裡只需串接
+        markdown_content = header + "".join(
+            message.get("_md") or format_message_md(message) for message in messages
+        )
+
+        # 圖表直接由已寫入磁碟的 PNG 檔分塊寫入 ZIP，不經過中間的 bytes 複本
+        for message in messages:
+            for path in message.get("figure_paths", ()):
+                if os.path.exists(path):
+                    zip_f.write(path, arcname=os.path.basename(path))
+        zip_f.writestr(
+            "分析報告.md", markdown_content.encode('utf-8'),
+            compress_type=zipfile.ZIP_DEFLATED, compresslevel=6,
+        )
+    return zip_buffer.getvalue()
 
 # --- 輔助函數：紀錄 LLM 互動 ---
+LLM_LOG_FILE = "llm_debug_log.txt"
+
+# 單一背景執行緒依序寫入除錯紀錄：寫檔不阻塞分析流程，且清空與寫入的順序不會錯亂
+@st.cache_resource
+def get_log_writer():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm_log")
+
+# 除錯紀錄檔保持開啟，每筆紀錄不再重新 open/close (只由 llm_log 執行緒寫入)
+@st.cache_resource
+def get_log_file():
+    return open(LLM_LOG_FILE, "a", encoding="utf-8")
+
+def _write_log(f, text, truncate=False):
+    if truncate:
+        f.truncate(0)
+    f.write(text)
+    f.flush()
+
+def reset_llm_log():
+    """清空除錯紀錄 (檔案不存在時建立)"""
+    get_log_writer().submit(_write_log, get_log_file(), "", True)
+
 def log_llm_interaction(step_name, messages, response_content):
     """
     將 LLM 的輸入與輸出紀錄到檔案中，方便除錯。
+    整筆紀錄先組成單一字串，再交由背景執行緒一次寫入。
     """
-    log_file = "llm_debug_log.txt"
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(f"\n{'='*30}\n")
-        f.write(f"[{timestamp}] Step: {step_name}\n")
-        f.write(f"{'-'*30}\n")
-        f.write("[Input Messages]:\n")
-        for msg in messages:
-            role = msg.get("role", "unknown")
-            content = msg.get("content", "")
-            f.write(f"  <{role.upper()}>\n{content}\n")
-        
-        f.write(f"\n[Output Response]:\n{response_content}\n")
-        f.write(f"{'='*30}\n")
+
+    parts = [
+        f"\n{'='*30}\n",
+        f"[{timestamp}] Step: {step_name}\n",
+        f"{'-'*30}\n",
+        "[Input Messages]:\n",
+    ]
+    for msg in messages:
+        role = msg.get("role", "unknown")
+        content = msg.get("content", "")
+        parts.append(f"  <{role.upper()}>\n{content}\n")
+
+    parts.append(f"\n[Output Response]:\n{response_content}\n")
+    parts.append(f"{'='*30}\n")
+    get_log_writer().submit(_write_log, get_log_file(), "".join(parts))
+
+# --- 輔助函數：側邊欄報告匯出 ---
+# 報告在使用者按下「準備分析報告」後才建立，一般對話過程不做 PNG 輸出與壓縮。
+# 以 fragment 包裝，按鈕互動只重跑這個區塊，不重繪對話歷史。
+@st.fragment
+def render_report_export():
+    has_messages = "messages" in st.session_state and st.session_state.messages
+    report_file_name = f"羽球分析報告_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    if not has_messages:
+        st.download_button(
+            label="💾 下載分析報告 (ZIP)",
+            data=b"",
+            file_name=report_file_name,
+            mime="application/zip",
+            disabled=True
+        )
+    else:
+        # 報告 bytes 依對話簽章存於 session_state：每個 session 只保留最新一份，
+        # session 結束即釋放；重新執行時直接沿用同一個 bytes 物件，不重新打包也不複製
+        messages_signature = get_messages_signature(st.session_state.messages)
+        report = st.session_state.get("report_zip")
+        if report is None or report[0] != messages_signature:
+            if st.button("📦 準備分析報告", help="整理目前的對話與圖表，完成後即可下載 ZIP"):
+                st.session_state.report_zip = (messages_signature, build_report_zip(st.session_state.messages))
+                st.rerun(scope="fragment")
+        else:
+            st.download_button(
+                label="💾 下載分析報告 (ZIP)",
+                data=report[1],
+                file_name=report_file_name,
+                mime="application/zip"
+            )
 
 # --- 🔒 通關密碼保護 (Simple Auth) ---
 # 這是為了讓 App 可公開網址 (方便分享)，但只讓知道密碼的人使用 (保護 API Key)
@@ -113,6 +575,9 @@ if not check_password():
 # --- 資料載入 ---
 df, data_schema_info, column_definitions_info = load_all_data()
 
+# 系統指令只依賴資料 schema 與欄位定義，於載入資料後組合一次，不在每輪對話重建
+system_prompt_base = create_system_prompt(data_schema_info, column_definitions_info) + BEST_PRACTICES_APPENDIX
+
 # --- Streamlit UI ---
 st.title("🏸 羽球 AI 數據分析師")
 st.markdown("#### 透過自然語言，直接生成數據分析圖表")
@@ -146,6 +611,8 @@ with st.sidebar:
                     
                     # 清除快取以確保載入新資料
                     st.cache_data.clear()
+                    load_all_data.clear()
+                    load_player_matches.clear()
                     
                     st.success("✅ 資料處理完成！請稍候，頁面將自動重整...")
                     st.rerun()
@@ -162,6 +629,18 @@ with st.sidebar:
     # 多輪問答開關
     enable_clarification = st.checkbox("啟用多輪問答（問題不明確時會主動詢問）", value=False)
 
+    # 邏輯檢查開關：關閉時僅在結果為空或沒有任何輸出時才執行 Step 4
+    always_reflect = st.checkbox("每次都執行 AI 邏輯檢查（較慢）", value=False)
+
+    # 資料範圍開關：只載入問題中提到的球員有出賽的比賽 (問題涉及全體球員比較時請關閉)
+    scope_by_player = st.checkbox("依問題中的球員縮小資料範圍（較快）", value=False, help="只分析提到的球員有出賽的比賽；若要與全部球員比較請關閉。")
+
+    # 相似問題快取：以 embedding 比對先前問過的問題，語意相同 (且球員、數字條件相同) 時沿用程式碼
+    use_semantic_cache = st.checkbox("相似問題沿用快取程式碼（需 embedding API）", value=False, help="多一次 embedding 請求，換取相似問題跳過 Step 0~2。")
+
+    # 接續前文時送給 LLM 的最大對話輪數 (每輪 = 一問一答)
+    history_turns = st.slider("接續前文的對話輪數", min_value=1, max_value=10, value=4, help="開啟「接續前文」時，僅帶入最近 N 輪問答，避免 prompt 隨對話無限增長。")
+
     st.divider()
     st.markdown("#### 範例問題")
     st.info("""
@@ -173,43 +652,7 @@ with st.sidebar:
     st.divider()
 
     # --- ZIP 匯出功能 ---
-    zip_buffer = io.BytesIO()
-    has_messages = "messages" in st.session_state and st.session_state.messages
-    if has_messages:
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_f:
-            markdown_content = f"# 🏸 羽球 AI 數據分析師 - 分析報告\n"
-            markdown_content += f"**儲存時間:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n---\n\n"
-            chart_counter = 0
-            for message in st.session_state.messages:
-                role_emoji = "👤" if message["role"] == "user" else "🤖"
-                role_title = "使用者提問" if message["role"] == "user" else "AI 分析師回覆"
-                content_to_save = message["content"]
-                
-                # 在儲存時，將程式碼區塊保留
-                markdown_content += f"### {role_emoji} {role_title}\n{content_to_save.strip()}\n\n"
-                
-                figures = message.get("figures", [])
-                if not figures and message.get("figure"):
-                    figures = [message["figure"]]
-
-                for fig in figures:
-                    chart_counter += 1
-                    chart_filename = f"chart_{chart_counter}.png"
-                    img_buffer = io.BytesIO()
-                    fig.savefig(img_buffer, format='png', dpi=300, bbox_inches='tight')
-                    img_buffer.seek(0)
-                    zip_f.writestr(chart_filename, img_buffer.getvalue())
-                    markdown_content += f"![產生的圖表 {chart_counter}]({chart_filename})\n\n"
-                markdown_content += "---\n\n"
-            zip_f.writestr("分析報告.md", markdown_content.encode('utf-8'))
-
-    st.download_button(
-        label="💾 下載分析報告 (ZIP)",
-        data=zip_buffer.getvalue(),
-        file_name=f"羽球分析報告_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
-        mime="application/zip",
-        disabled=not has_messages
-    )
+    render_report_export()
 
     if st.button("🗑️ 清除對話"):
         st.session_state.messages = []
@@ -219,6 +662,8 @@ with st.sidebar:
 client = initialize_client(api_mode, api_key_input)
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 # 初始化多輪問答狀態
 if "awaiting_clarification" not in st.session_state:
@@ -229,30 +674,30 @@ if "original_prompt" not in st.session_state:
     st.session_state.original_prompt = ""
 
 # 顯示歷史
-for idx, message in enumerate(st.session_state.messages):
-    with st.chat_message(message["role"]):
-        # [修改點]：若有優化後的提問邏輯，顯示在對話中
-        if message.get("enhanced_prompt"):
-            with st.expander("🧠 查看 AI 優化後的提問邏輯 (Step 1)", expanded=False):
-                st.markdown(f"**優化導引 (Enhanced Prompt):**\n{message['enhanced_prompt']}")
-
-        st.markdown(message["content"])
-        figures = message.get("figures", [])
-        if not figures and message.get("figure"):
-            figures = [message["figure"]]
-
-        for fig_idx, fig in enumerate(figures):
-            st.pyplot(fig)
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-            buf.seek(0)
-            st.download_button(
-                label=f"📥 下載圖表 {fig_idx + 1}",
-                data=buf,
-                file_name=f"羽球分析_{idx}_{fig_idx}_{datetime.now().strftime('%Y%m%d')}.png",
-                mime="image/png",
-                key=f"download_history_{idx}_{fig_idx}",
-            )
+# 以 fragment 包裝：歷史訊息中的下載按鈕只重跑此區塊，不觸發整個腳本 (含側邊欄) 重新執行
+@st.fragment
+def render_history():
+    for idx, message in enumerate(st.session_state.messages):
+        with st.chat_message(message["role"]):
+            # [修改點]：若有優化後的提問邏輯，顯示在對話中
+            if message.get("enhanced_prompt"):
+                with st.expander("🧠 查看 AI 優化後的提問邏輯 (Step 1)", expanded=False):
+                    st.markdown(f"**優化導引 (Enhanced Prompt):**\n{message['enhanced_prompt']}")
+
+            st.markdown(message["content"])
+            # 圖表已在建立訊息時存成 PNG 檔，重新執行時直接顯示圖片，不必再繪製 Figure
+            for fig_idx, (preview_png, export_png) in enumerate(get_message_pngs(message)):
+                # 與 st.pyplot 相同以容器寬度顯示預覽圖，下載提供高解析度版本
+                st.image(preview_png, use_container_width=True)
+                st.download_button(
+                    label=f"📥 下載圖表 {fig_idx + 1}",
+                    data=export_png,
+                    file_name=f"羽球分析_{idx}_{fig_idx}_{datetime.now().strftime('%Y%m%d')}.png",
+                    mime="image/png",
+                    key=f"download_history_{idx}_{fig_idx}",
+                )
+
+render_history()
 
 # --- 主對話流程 ---
 # 添加歷史紀錄開關
@@ -260,8 +705,7 @@ use_history = st.toggle("🔗 接續前文 (Track History)", value=False, help="
 
 if prompt := st.chat_input("請輸入你的數據分析問題..."):
     # Clear debug log on new input (create if not exists, truncate if exists)
-    with open("llm_debug_log.txt", "w", encoding="utf-8") as f:
-        pass # Truncate file to 0 bytes
+    reset_llm_log()
 
     if df is None:
         st.error("❌ 找不到 'all_dataset.csv'。")
@@ -285,7 +729,7 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
             full_prompt = f"{st.session_state.original_prompt}\n補充說明: {user_answer}"
 
             # 記錄使用者的補充回應
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            append_message({"role": "user", "content": prompt})
 
             # 重置澄清狀態
             st.session_state.awaiting_clarification = False
@@ -296,7 +740,7 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
             skip_clarification = True
         else:
             # 儲存問題與追蹤狀態
-            st.session_state.messages.append({
+            append_message({
                 "role": "user", 
                 "content": prompt,
                 "tracked": use_history # 儲存當前是否開啟追蹤
@@ -305,51 +749,108 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
         with st.chat_message("user"):
             st.markdown(prompt)
 
+        plt, sns = load_plotting_libs()
+
         with st.chat_message("assistant"):
             # 使用 st.status 來顯示多步驟進程
             with st.status("AI 數據分析師正在處理中...") as status:
                 try:
+                    # --- [程式碼快取] ---
+                    # 相同問題 (同模型、同資料) 直接沿用上次通過邏輯檢查的程式碼，跳過 Step 0~2
+                    # 接續前文時問題語意依賴歷史對話，因此不使用快取
+                    code_cache_key = make_cache_key(
+                        model_choice, data_schema_info, column_definitions_info, normalize_prompt(prompt)
+                    )
+                    cached_entry = None if use_history else cache_get(CODE_CACHE_PATH, code_cache_key)
+
+                    # 完全相同的問題未命中時，再以語意相似度查詢 (失敗時視為未命中)
+                    semantic_scope = semantic_vector = None
+                    cache_source = "exact" if cached_entry is not None else None
+                    if cached_entry is None and use_semantic_cache and not use_history:
+                        try:
+                            mentioned_players = find_mentioned_players(prompt, load_player_matches())
+                            if has_unresolved_names(prompt, mentioned_players):
+                                # 問題中的名字對不到任何球員：條件不明確，不以相似度沿用其他問題的程式碼
+                                raise LookupError("unresolved player names in prompt")
+                            semantic_scope = make_cache_key(
+                                model_choice, data_schema_info, column_definitions_info,
+                                question_entities(prompt, mentioned_players),
+                            )
+                            semantic_vector = embed_text(client, normalize_prompt(prompt))
+                            cached_entry = get_semantic_cache().get(semantic_scope, semantic_vector)
+                            if cached_entry is not None:
+                                cache_source = "semantic"
+                        except Exception as e:
+                            log.info("Semantic cache lookup skipped: %s", e)
+                            semantic_vector = None
+                    st.session_state["from_cache"] = cache_source
+
+                    # [新增]: 提前準備歷史對話 (供 Step 1 與 Step 2 共用)
+                    recent_history = []
+                    if use_history and len(st.session_state.messages) > 1:
+                        # 1. 先收集所有有效的歷史訊息
+                        # 邏輯: 倒序遍歷，遇到 "tracked=False" 的訊息則立即停止 (Chain Breaking)
+                        # 2. 僅保留最後 history_turns 輪問答 (每輪 2 則訊息)，收集足夠即停止往回掃描
+                        max_history_messages = history_turns * 2
+                        valid_history = []
+                        # 3. 只有最近一則 AI 回覆保留完整內容 (修改上一題圖表需要其程式碼)，
+                        #    更早的回覆移除程式碼並截斷為摘要，避免 prompt 隨對話長度線性成長
+                        keep_full_reply = True
+                        
+                        # 從倒數第二則訊息開始往回看 (排除當前最新訊息)
+                        for m in reversed(st.session_state.messages[:-1]):
+                            # 如果遇到沒有開啟追蹤的訊息，視為斷點，停止收集更早的歷史
+                            if not m.get("tracked", True): 
+                                break
+                                
+                            if m.get("content") and "🤔" not in m.get("content", ""):
+                                content = m["content"]
+                                if m["role"] == "assistant":
+                                    if not keep_full_reply:
+                                        content = truncate_text(strip_code_blocks(content), HISTORY_GIST_CHARS)
+                                    keep_full_reply = False
+                                valid_history.append({"role": m["role"], "content": content})
+                                if len(valid_history) >= max_history_messages:
+                                    break
+                        
+                        # 倒序收集後反轉回時間順序
+                        recent_history = valid_history[::-1]
+
+                    # Step 0 與 Step 1 互不相依：先在背景送出 Step 1 的請求，與 Step 0 的澄清檢查同時進行
+                    enhancement_future = None
+                    if cached_entry is None:
+                        messages_1 = [{"role": "system", "content": ENHANCEMENT_SYSTEM_PROMPT}]
+                    
+                        # [新增] 注入歷史紀錄，讓 Step 1 能理解「圓餅圖」是指「上一題的圓餅圖」
+                        # 問題轉化只需要前文的問答文字，移除 AI 回覆中的程式碼區塊以縮短 prompt
+                        # (Step 2 仍帶入完整內容，修改上一題圖表時需要參考先前的程式碼)
+                        if recent_history:
+                            messages_1.extend(
+                                {"role": m["role"], "content": strip_code_blocks(m["content"]) if m["role"] == "assistant" else m["content"]}
+                                for m in recent_history
+                            )
+
+                        messages_1.append({"role": "user", "content": prompt})
+                        messages_1 = trim_messages(messages_1, model_choice)
+                        enhancement_future = get_llm_executor().submit(
+                            cached_chat_completion, client, model_choice, messages_1, 0.2
+                        )
+
                     # --- [Step 0: 問題檢查與澄清] ---
-                    if not skip_clarification and enable_clarification:
+                    if not skip_clarification and enable_clarification and cached_entry is None:
                         status.update(label="Step 0/6: 檢查問題是否需要澄清...")
 
-                        import json
-                        clarification_check_prompt = f"""
-                        檢查問題是否明確 (含球員/時間/比較對象)。無法判斷則回傳 JSON 請求澄清。
-                        問題: "{prompt}"
-                        欄位: {data_schema_info}
-                        輸出: "CLEAR" 或 JSON:
-                        {{
-                        "need_clarification": true,
-                        "question": "請問您要...",
-                        "options": ["選項1...", "選項2..."]
-                        }}
-                        """
+                        clarification_check_prompt = CLARIFICATION_PROMPT_TEMPLATE.format(prompt=prompt, data_schema_info=data_schema_info)
 
                         messages_0 = [{"role": "user", "content": clarification_check_prompt}]
-                        clarification_response = client.chat.completions.create(
-                            model=model_choice,
-                            messages=messages_0,
-                            temperature=0.3
-                        )
-                        clarification_content = clarification_response.choices[0].message.content.strip()
+                        clarification_content = cached_chat_completion(client, model_choice, messages_0, 0.3).strip()
                         log_llm_interaction("Step 0: Clarification Check", messages_0, clarification_content)
 
                         # 檢查是否需要澄清
                         if "CLEAR" not in clarification_content:
                             try:
-                                # 提取 JSON
-                                json_str = clarification_content
-                                if "```json" in clarification_content:
-                                    start = clarification_content.find("```json") + 7
-                                    end = clarification_content.find("```", start)
-                                    json_str = clarification_content[start:end].strip()
-                                elif "```" in clarification_content:
-                                    start = clarification_content.find("```") + 3
-                                    end = clarification_content.find("```", start)
-                                    json_str = clarification_content[start:end].strip()
-
-                                clarification_data = json.loads(json_str)
+                                # 提取並解析 JSON
+                                clarification_data = parse_json_response(clarification_content)
 
                                 if clarification_data.get("need_clarification"):
                                     # 設定澄清狀態
@@ -361,185 +862,161 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
                                     st.markdown(f"### 🤔 {clarification_data['question']}")
                                     st.info("請在下方輸入框中選擇以下選項之一（輸入選項編號或完整描述），或直接輸入您的補充說明：")
 
-                                    options_text = ""
+                                    option_lines = []
                                     for i, option in enumerate(clarification_data['options'], 1):
                                         option_line = f"**{i}.** {option}"
                                         st.markdown(option_line)
-                                        options_text += f"{i}. {option}\n"
+                                        option_lines.append(f"{i}. {option}\n")
 
                                     # 儲存助手回應到歷史
-                                    clarification_msg = f"### 🤔 {clarification_data['question']}\n\n"
-                                    clarification_msg += "請選擇以下選項之一，或直接提供補充說明：\n\n"
-                                    clarification_msg += options_text
+                                    clarification_msg = "".join([
+                                        f"### 🤔 {clarification_data['question']}\n\n",
+                                        "請選擇以下選項之一，或直接提供補充說明：\n\n",
+                                        *option_lines,
+                                    ])
 
-                                    st.session_state.messages.append({
+                                    append_message({
                                         "role": "assistant",
                                         "content": clarification_msg,
-                                        "figures": []
+                                        "figure_paths": []
                                     })
 
                                     status.update(label="等待您的補充資訊...", state="complete")
+                                    # 需要澄清時不會用到 Step 1 的結果 (若尚未開始則直接取消)
+                                    if enhancement_future is not None:
+                                        enhancement_future.cancel()
                                     st.stop()
 
-                            except json.JSONDecodeError:
+                            except ValueError:
                                 # JSON 解析失敗，繼續正常流程
                                 pass
 
                     # --- [Step 1: 轉化使用者問題] ---
-                    status.update(label="Step 1/6: 正在釐清您的問題...")
-
-                    # [新增]: 提前準備歷史對話 (供 Step 1 與 Step 2 共用)
-                    recent_history = []
-                    if use_history and len(st.session_state.messages) > 1:
-                        # 1. 先收集所有有效的歷史訊息
-                        # 邏輯: 倒序遍歷，遇到 "tracked=False" 的訊息則立即停止 (Chain Breaking)
-                        valid_history = []
-                        
-                        # 從倒數第二則訊息開始往回看 (排除當前最新訊息)
-                        for m in reversed(st.session_state.messages[:-1]):
-                            # 如果遇到沒有開啟追蹤的訊息，視為斷點，停止收集更早的歷史
-                            if not m.get("tracked", True): 
-                                break
-                                
-                            if m.get("content") and "🤔" not in m.get("content", ""):
-                                # 插入到最前面以保持時間順序
-                                valid_history.insert(0, {"role": m["role"], "content": m["content"]})
-                        
-                        # 2. 僅保留最後 4 輪問答 (4 * 2 = 8 則訊息)
-                        recent_history = valid_history[-8:]
-
-                    
-                    enhancement_system_prompt = f"""
-                    你是羽球資料分析輔助系統，比賽階層: 場次 -> 局數 -> 回合 -> 第幾球，若跳階層查詢必須給予中間的階層，融入於問題中。請分析使用者問題：
-                    1. 將簡短問題轉化為精準完整的數據分析問題 (Enhanced Prompt)，勿過度詮釋，用繁體中文。
-                    2. 判斷問題是否可能用到場地資訊。若不確定，輸出true
-                       - 若問題可能需要用到場地資訊：前場/中場/後場、網前/底線/邊線、落點、站位、區域 (Area/Zone/Location)... -> true
-
-                    輸出 JSON (No Markdown):
-                    {{
-                        "enhanced_prompt": "完整的問題",
-                        "needs_court_info": true/false
-                    }}
-                    """
-                    
-                    messages_1 = [{"role": "system", "content": enhancement_system_prompt}]
-                    
-                    # [新增] 注入歷史紀錄，讓 Step 1 能理解「圓餅圖」是指「上一題的圓餅圖」
-                    if recent_history:
-                        messages_1.extend(recent_history)
-
-                    messages_1.append({"role": "user", "content": prompt})
-                    enhancement_response = client.chat.completions.create(
-                        model=model_choice,
-                        messages=messages_1,
-                        temperature=0.2
-                    )
-                    
-                    # 解析回應
-                    raw_content = enhancement_response.choices[0].message.content.strip()
-                    log_llm_interaction("Step 1: Enhancement", messages_1, raw_content)
-                    enhanced_prompt = raw_content
-                    needs_court_info = False
-
-                    try:
-                        import json
-                        # 嘗試移除 Markdown 標記
-                        json_str = raw_content
-                        if "```json" in raw_content:
-                            start = raw_content.find("```json") + 7
-                            end = raw_content.rfind("```")
-                            json_str = raw_content[start:end].strip()
-                        elif "```" in raw_content:
-                            start = raw_content.find("```") + 3
-                            end = raw_content.rfind("```")
-                            json_str = raw_content[start:end].strip()
-                        
-                        parsed = json.loads(json_str)
-                        enhanced_prompt = parsed.get("enhanced_prompt", raw_content)
-                        needs_court_info = parsed.get("needs_court_info", False)
-                    except:
-                        print(f"Enhancement JSON parse failed, using raw text. Content: {raw_content[:50]}...")
-                        # Fallback: 如果解析失敗，假設不需要場地資訊，或者如果關鍵字出現則設為True
-                        if any(k in prompt for k in ["落點", "位置", "區域", "座標", "location", "area"]):
-                            needs_court_info = True
-
-                    print(f"Enhanced Prompt: {enhanced_prompt}")
-                    print(f"Needs Court Info: {needs_court_info}")
+                    if cached_entry:
+                        status.update(label="Step 1/6: 找到相同問題的快取程式碼，跳過問題轉化與程式碼生成...")
+                    else:
+                        status.update(label="Step 1/6: 正在釐清您的問題...")
+
+                    if cached_entry:
+                        enhanced_prompt = cached_entry["enhanced_prompt"]
+                        needs_court_info = cached_entry["needs_court_info"]
+                    else:
+                        # 解析回應
+                        raw_content = enhancement_future.result().strip()
+                        log_llm_interaction("Step 1: Enhancement", messages_1, raw_content)
+                        enhanced_prompt = raw_content
+                        needs_court_info = False
+
+                        try:
+                            # 移除 Markdown 標記並解析 JSON
+                            parsed = parse_json_response(raw_content)
+                            enhanced_prompt = parsed.get("enhanced_prompt", raw_content)
+                            needs_court_info = parsed.get("needs_court_info", False)
+                        except:
+                            log.warning("Enhancement JSON parse failed, using raw text. Content: %s...", raw_content[:50])
+                            # Fallback: 如果解析失敗，假設不需要場地資訊，或者如果關鍵字出現則設為True
+                            if any(k in prompt for k in ["落點", "位置", "區域", "座標", "location", "area"]):
+                                needs_court_info = True
+
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug(f"Enhanced Prompt: {enhanced_prompt}")
+                        log.debug(f"Needs Court Info: {needs_court_info}")
 
                     # --- [Step 2: 生成分析程式碼] ---
-                    status.update(label="Step 2/6: 正在生成分析程式碼...")
-                    system_prompt = create_system_prompt(data_schema_info, column_definitions_info)
+                    if not cached_entry:
+                        status.update(label="Step 2/6: 正在生成分析程式碼...")
+                    system_prompt = system_prompt_base
                     
                     # 動態注入場地資訊
                     if needs_court_info and court_place_info:
                         system_prompt += f"\n\n**場地位置參考資訊 (Court Grid Definitions):**\n{court_place_info}\n"
 
-                    # [修改點]：注入通用且穩健的視覺化指導原則，而非強制特定方法
-                    system_prompt += """
-                    \n**最佳實踐:**
-                    1. 區分連續數值(Float)與類別。座標勿直接 groupby。
-                    2. 軸標籤避免大量浮點數。
-                    3. 繪圖前檢查 `if len(filtered_df) > 0:`。
-                    """
-
                     conversation = [{"role": "system", "content": system_prompt}]
                     
                     # [修改點]：直接使用早已準備好的 recent_history
                     if recent_history:
                         conversation.extend(recent_history)
                     
-                    conversation.append({"role": "user", "content": enhanced_prompt})
-
-                    response = client.chat.completions.create(
-                        model=model_choice, messages=conversation
-                    )
-                    ai_response = response.choices[0].message.content
-                    log_llm_interaction("Step 2: Code Generation", conversation, ai_response)
+                    task_message = {"role": "user", "content": enhanced_prompt}
+                    conversation.append(task_message)
+                    # 預先檢查 token 數，超出模型上限時由最舊的歷史對話開始捨棄 (本題的任務描述一律保留)
+                    conversation = trim_messages(conversation, model_choice, pinned=(task_message,))
+
+                    if cached_entry:
+                        code_to_execute = cached_entry["code"]
+                    else:
+                        # 串流接收並即時顯示生成進度，完成後清除 (最終程式碼於下方 expander 顯示)
+                        code_preview = st.empty()
+                        preview_writer = ThrottledWriter(lambda text: code_preview.code(text, language="python"))
+                        response_stream = client.chat.completions.create(
+                            model=model_choice, messages=conversation, stream=True
+                        )
+                        for chunk in response_stream:
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                preview_writer.push(chunk.choices[0].delta.content)
+                        code_preview.empty()
+                        ai_response = preview_writer.text()
+                        log_llm_interaction("Step 2: Code Generation", conversation, ai_response)
 
-                    # 取出 Python code
-                    code_to_execute = None
-                    if "```python" in ai_response:
-                        start = ai_response.find("```python") + len("```python\n")
-                        end = ai_response.rfind("```")
-                        code_to_execute = ai_response[start:end].strip()
+                        # 取出 Python code
+                        code_to_execute = extract_code(ai_response)
 
                     # --- [Step 3: 執行程式 (Runtime Error Fix Loop)] ---
                     status.update(label="Step 3/6: 正在執行程式碼...")
                     
+                    # 依問題中提到的球員縮小資料範圍 (以整場比賽為單位)
+                    exec_df = df
+                    if scope_by_player:
+                        exec_df = scope_to_players(df, f"{prompt}\n{enhanced_prompt}", load_player_matches())
+                        log.info("Scoped data to %d/%d rows", len(exec_df), len(df))
+
                     final_figs = []
                     summary_info = {}
+                    summary_table = None # AI 程式碼指定給 `summary` 的結果表格
                     exec_globals = {} # 初始化環境變數
                     execution_output = "" # [Fix] Ensure variable is defined even if no code is generated
                     
                     if code_to_execute:
                         max_retries = 3
+                        # 發生錯誤時以不同 temperature 同時請求多份修正：先回來的先執行，
+                        # 其餘留作備援，下一次仍失敗時直接取用，不必再等一次 LLM 往返。
+                        # 備援只能替代同一輪的修正：code_round 記錄目前程式碼來自第幾輪修正 (0 為原始程式碼)，
+                        # pending_round 記錄備援是哪一輪送出的，兩者不同時備援修正的是舊錯誤，直接丟棄
+                        pending_corrections = []
+                        pending_round = code_round = 0
+                        correction_messages = None # 送出修正請求時的對話快照
                         retry_count = 0
                         success = False
                         last_error = None
+                        figure_tracker = FigureTracker(plt)
+                        # 執行環境範本：模組只建立一次，每次執行只替換 df (exec 會寫入 globals，故仍需複製 dict)
+                        # 加入 sns 到執行環境，提供更多彈性
+                        exec_template = {
+                            "pd": pd,
+                            "st": st,
+                            "platform": platform,
+                            "io": io,
+                            "plt": plt,
+                            "sns": sns,
+                        }
                         
                         # 迴圈 1: 處理語法/執行錯誤 (Syntax/Runtime Errors)
                         while retry_count <= max_retries:
                             try:
-                                # 重要：每次執行前清除 Matplotlib 狀態，避免上一張圖殘留或干擾
-                                plt.close('all')
-                                
                                 # 準備執行環境，確保 df 存在
-                                # 加入 sns 到執行環境，提供更多彈性
-                                exec_globals = {
-                                    "pd": pd, 
-                                    "df": df.copy(), 
-                                    "st": st, 
-                                    "platform": platform, 
-                                    "io": io, 
-                                    "plt": plt,
-                                    "sns": sns 
-                                }
-                                f = io.StringIO()
-                                with redirect_stdout(f):
-                                    exec(code_to_execute, exec_globals)
-                                execution_output = f.getvalue()
+                                # df 以淺複製傳入 (Copy-on-Write 下不複製資料)，新增/覆寫欄位不會影響共用的 df
+                                exec_globals = {**exec_template, "df": exec_df.copy(deep=False)}
+                                # 每次執行前關閉上一次嘗試開啟的圖表，並使用新的 tracker
+                                figure_tracker = figure_tracker.renew()
+                                execution_output = run_generated_code(
+                                    code_to_execute, exec_globals, figure_tracker,
+                                    on_wait=lambda elapsed: status.update(label=f"Step 3/6: 正在執行程式碼... (已執行 {elapsed:.0f} 秒)"),
+                                )
                                 success = True
                                 break 
+                            except CodeExecutionTimeout:
+                                # 逾時的程式碼仍在背景執行 (共用 pyplot 狀態)，不在此時重跑修正版本，直接結束本次分析
+                                raise
                             except Exception as e:
                                 retry_count += 1
                                 last_error = e
@@ -549,167 +1026,171 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
                                 error_feedback = f"執行上述程式碼時發生錯誤: {str(e)}。請修正錯誤並重新輸出完整程式碼 (包含必要的 import)。"
                                 conversation.append({"role": "user", "content": error_feedback})
                                 
-                                correction_response = client.chat.completions.create(model=model_choice, messages=conversation)
-                                ai_correction = correction_response.choices[0].message.content
-                                log_llm_interaction(f"Step 3: Error Fix (Retry {retry_count})", conversation, ai_correction)
-                                
-                                if "```python" in ai_correction:
-                                    start = ai_correction.find("```python") + len("```python\n")
-                                    end = ai_correction.rfind("```")
-                                    code_to_execute = ai_correction[start:end].strip() # 更新代碼
+                                conversation = trim_messages(conversation, model_choice, pinned=(task_message,))
+
+                                if pending_round != code_round:
+                                    for fut in pending_corrections:
+                                        fut.cancel()
+                                    pending_corrections = []
+
+                                corrected_code = None
+                                # 備援修正的請求失敗 (如 429) 時略過，不讓單一請求的錯誤中斷整個分析
+                                while pending_corrections and corrected_code is None:
+                                    try:
+                                        ai_correction = pending_corrections.pop(0).result().choices[0].message.content
+                                    except Exception as correction_error:
+                                        log.warning("Speculative correction request failed: %s", correction_error)
+                                        continue
+                                    log_llm_interaction(f"Step 3: Error Fix (Retry {retry_count}, speculative)", correction_messages, ai_correction)
+                                    corrected_code = extract_code(ai_correction)
+
+                                if corrected_code is None:
+                                    # 背景請求使用對話快照：之後的 append / trim 不會影響尚在送出中的請求
+                                    correction_messages = list(conversation)
+                                    pending_round = retry_count
+                                    correction_futures = [
+                                        get_llm_executor().submit(
+                                            client.chat.completions.create,
+                                            model=model_choice,
+                                            messages=correction_messages,
+                                            temperature=temperature,
+                                        )
+                                        for temperature in CORRECTION_TEMPERATURES
+                                    ]
+                                    # 取第一個成功的回應，其餘 (尚未失敗的) 留作備援
+                                    ai_correction = None
+                                    failed_corrections = []
+                                    for fut in as_completed(correction_futures):
+                                        try:
+                                            ai_correction = fut.result().choices[0].message.content
+                                        except Exception as correction_error:
+                                            log.warning("Correction request failed: %s", correction_error)
+                                            failed_corrections.append(fut)
+                                            continue
+                                        pending_corrections = [
+                                            other for other in correction_futures
+                                            if other is not fut and other not in failed_corrections
+                                        ]
+                                        break
+
+                                    if ai_correction is None:
+                                        # 同時送出的請求全部失敗 (常見於 429)，改送單一請求再試一次；仍失敗才中斷分析
+                                        ai_correction = client.chat.completions.create(
+                                            model=model_choice,
+                                            messages=correction_messages,
+                                            temperature=CORRECTION_TEMPERATURES[0],
+                                        ).choices[0].message.content
+                                    log_llm_interaction(f"Step 3: Error Fix (Retry {retry_count})", correction_messages, ai_correction)
+                                    corrected_code = extract_code(ai_correction)
+
+                                if corrected_code:
+                                    code_to_execute = corrected_code # 更新代碼
+                                    code_round = pending_round
+
+                        # 已成功執行時不再需要備援修正：只能取消尚未送出的請求，已送出的請求無法中止 (仍會計費)
+                        for fut in pending_corrections:
+                            fut.cancel()
 
                         if not success:
                             raise last_error
 
                         # --- 提取變數 (供下一步邏輯檢查使用) ---
-                        ignore_list = ['df', 'pd', 'st', 'platform', 'io', 'fig', 'np', 'plt', 'sns']
-                        
                         # 檢查生成的圖表數量
-                        created_figs = [plt.figure(n) for n in plt.get_fignums()]
+                        created_figs = figure_tracker.figures()
                         if not created_figs and "fig" in exec_globals:
                              created_figs = [exec_globals["fig"]]
                         
+                        summary_info = summarize_namespace(exec_globals)
                         summary_info["_generated_figures_count"] = len(created_figs)
 
-                        for name, val in exec_globals.items():
-                            if name.startswith('_') or name in ignore_list: continue
-                            
-                            try:
-                                # [Fix] 避免 class 物件觸發 object of type 'type' has no len()
-                                if isinstance(val, type):
-                                    continue
-
-                                if isinstance(val, (int, float, str, bool)):
-                                    summary_info[name] = val
-                                elif isinstance(val, (pd.DataFrame, pd.Series)):
-                                    # 強制讓 LLM 知道資料是空的
-                                    if val.empty:
-                                        summary_info[name] = "⚠️ Empty DataFrame/Series (0 rows)"
-                                    else:
-                                        # 如果資料太大，只告訴 LLM 大小，不傳全部內容
-                                        summary_info[name] = f"DataFrame/Series with {len(val)} rows"
-                                elif hasattr(val, '__len__') and len(val) < 20:
-                                    summary_info[name] = val
-                            except Exception:
-                                pass
-
                         # --- [Step 4: 邏輯反饋與修正 (Logic Reflection Loop)] ---
-                        status.update(label="Step 4/6: AI 正在檢查分析結果的邏輯性...")
-                        
-                        reflection_context = ""
-                        for name, val in summary_info.items():
-                            reflection_context += f"{name}: {val}\n"
+                        # 本地即可判斷的成功情況 (沒有空表格，且有圖表或文字輸出) 直接視為 PASS，省去一次 LLM 往返；
+                        # 出現空資料或完全沒有輸出時才請 AI 審查與修正
+                        needs_reflection = (
+                            always_reflect
+                            or has_empty_frames(exec_globals)
+                            or (not created_figs and not execution_output)
+                        )
+                        new_code = None
+                        reflection_passed = False # 只有 AI 實際審查並回覆 PASS 才寫入共用的程式碼快取
+                        if needs_reflection:
+                            status.update(label="Step 4/6: AI 正在檢查分析結果的邏輯性...")
                         
-                        if not reflection_context:
-                            reflection_context = "(無特定輸出變數，這通常表示沒有計算出任何數據)"
-                        reflection_prompt = f"""
-                        [查核資料]
-                        1. 問題: "{prompt}"
-                        2. 程式碼:
-                        ```python
-                        {code_to_execute}
-                        ```
-                        3. 執行與變數: {execution_output}
-                        {reflection_context}
-
-                        你是嚴格的「程式碼邏輯審計員 (Code Auditor)」。請先**逐步推理 (Chain of Thought)**，找出程式碼邏輯與使用者問題不符之處，並列出具體錯誤，最後再決定是否修正。
-                        **重要檢查清單:**
-                        - 確認程式碼是否有明確解決問題
-                        - 確認程式碼在實作細節上和邏輯上是否合理
-                        - 執行結果是否合理
-
-                        **邏輯錯誤案例:**
-                        - 🐛 **邏輯潛在錯誤**: 
-                            - 資料完整性: 變數是否被不當覆蓋？dropna 是否刪除了過多資料？
-                            - 統計正確性: groupby + sum/mean/count 是否符合題目語意？(如：求次數卻用 sum, 求總分卻用 count)
-                            - 欄位選用: 是否選錯欄位？ (如: player A vs player B)
-                        - 🎯 **意圖相符性**: 程式碼產出的圖表/數據，是否直接回答了使用者的問題？
-                        - ❌ **異常檢測**: 是否產生 `Empty/0 rows`？圖表是否空白 (`_generated_figures_count`=0)？
-                        - ⚠️ **視覺呈現**: 
-                            - 圓餅圖: 若小於 5% 的類別過多，**必須**合併為「其他 (Others)」。
-                            - 長條圖: X 軸標籤若過多導致擁擠難讀，應調整為水平長條圖或篩選 Top N。
-                        - 時間序是否搞錯: shift()邏輯需要使用嗎?是否使用正確?
-                        **回覆格式 (Format):**
-                        請嚴格遵守以下格式回覆：
+                            reflection_context = "".join(f"{name}: {val}\n" for name, val in summary_info.items())
                         
-                        [Reasoning]
-                        1. (觀察到的問題或確認正確的事實...)
-                        2. ...
-
-                        [Conclusion]
-                        (若需修正，請提供完整 Python 程式碼，包含必要的 import，並務必用 ```python 包裹)
-                        (若無需修正，請僅回覆單字: PASS)
-                        """
-                        messages_4 = [{"role": "user", "content": reflection_prompt}]
-                        reflection_response = client.chat.completions.create(
-                            model=model_choice,
-                            messages=messages_4,
-                            temperature=0.1
-                        )
-                        reflection_content = reflection_response.choices[0].message.content.strip()
-                        log_llm_interaction("Step 4: Logic Reflection", messages_4, reflection_content)
+                            if not reflection_context:
+                                reflection_context = "(無特定輸出變數，這通常表示沒有計算出任何數據)"
+                            reflection_prompt = REFLECTION_PROMPT_TEMPLATE.format(
+                                prompt=prompt,
+                                code_to_execute=code_to_execute,
+                                execution_output=execution_output,
+                                reflection_context=reflection_context,
+                            )
+                            messages_4 = [{"role": "user", "content": reflection_prompt}]
+                            reflection_content = cached_chat_completion(client, model_choice, messages_4, 0.1).strip()
+                            log_llm_interaction("Step 4: Logic Reflection", messages_4, reflection_content)
 
-                        if "```python" in reflection_content:
+                            new_code = extract_code(reflection_content)
+                            reflection_passed = new_code is None and "PASS" in reflection_content
+                        else:
+                            log.info("Reflection skipped: non-empty results with figures or stdout")
+
+                        if new_code:
                             # 觸發邏輯修正
                             status.update(label="Step 4/6: AI 發現資料為空或邏輯瑕疵，正在修正程式碼...", state="running")
-                            print(">>> Logic Refinement Triggered (Empty Data or Logic Error)")
-                            
-                            start = reflection_content.find("```python") + len("```python\n")
-                            end = reflection_content.rfind("```")
-                            new_code = reflection_content[start:end].strip()
+                            log.info("Logic Refinement Triggered (Empty Data or Logic Error)")
                             
                             try:
-                                plt.close('all') 
                                 # 重新初始化環境
-                                exec_globals = {
-                                    "pd": pd, 
-                                    "df": df.copy(), 
-                                    "st": st, 
-                                    "platform": platform, 
-                                    "io": io, 
-                                    "plt": plt,
-                                    "sns": sns 
-                                }
-                                f = io.StringIO()
-                                with redirect_stdout(f):
-                                    exec(new_code, exec_globals)
-                                execution_output = f.getvalue()
+                                exec_globals = {**exec_template, "df": exec_df.copy(deep=False)}
+                                figure_tracker = figure_tracker.renew()
+                                execution_output = run_generated_code(
+                                    new_code, exec_globals, figure_tracker,
+                                    on_wait=lambda elapsed: status.update(label=f"Step 4/6: 正在執行修正後的程式碼... (已執行 {elapsed:.0f} 秒)"),
+                                )
                                 
                                 code_to_execute = new_code 
                                 success = True 
                                 
-                                summary_info = {}
-                                for name, val in exec_globals.items():
-                                    if name.startswith('_') or name in ignore_list: continue
-                                    if isinstance(val, (int, float, str, bool)):
-                                        summary_info[name] = val
-                                    elif isinstance(val, (pd.DataFrame, pd.Series)):
-                                         summary_info[name] = f"DataFrame/Series with {len(val)} rows"
-                                    elif hasattr(val, '__len__') and len(val) < 20:
-                                        summary_info[name] = val
+                                summary_info = summarize_namespace(exec_globals)
                                         
+                            except CodeExecutionTimeout:
+                                # 修正版程式碼仍在背景執行，不再重跑原始程式碼，直接結束本次分析
+                                raise
                             except Exception as logic_fix_error:
-                                print(f"Logic refinement failed: {logic_fix_error}")
+                                log.warning("Logic refinement failed: %s", logic_fix_error)
                                 st.warning(f"⚠️ 嘗試優化圖表顯示時發生錯誤 ({logic_fix_error})，將顯示原始結果。")
                                 # Fallback: 重新執行原始程式碼以恢復圖表
                                 try:
-                                    plt.close('all')
-                                    exec_globals = {
-                                        "pd": pd, "df": df.copy(), "st": st, "platform": platform, 
-                                        "io": io, "plt": plt, "sns": sns
-                                    }
-                                    f = io.StringIO()
-                                    with redirect_stdout(f):
-                                        exec(code_to_execute, exec_globals)
-                                    execution_output = f.getvalue()
-                                except:
+                                    exec_globals = {**exec_template, "df": exec_df.copy(deep=False)}
+                                    figure_tracker = figure_tracker.renew()
+                                    execution_output = run_generated_code(code_to_execute, exec_globals, figure_tracker)
+                                except CodeExecutionTimeout:
+                                    raise
+                                except Exception:
                                     pass
 
-                        final_figs = [plt.figure(n) for n in plt.get_fignums()]
+                        elif reflection_passed and cached_entry is None:
+                            # 邏輯檢查實際執行且通過 (PASS)，才寫入程式碼快取供相同問題重複使用；
+                            # 略過審查 (僅依有無圖表/輸出判斷) 的結果不寫入，避免未經審查的程式碼重播給其他使用者
+                            code_cache_entry = {
+                                "code": code_to_execute,
+                                "enhanced_prompt": enhanced_prompt,
+                                "needs_court_info": needs_court_info,
+                            }
+                            cache_set(CODE_CACHE_PATH, code_cache_key, code_cache_entry)
+                            if semantic_vector is not None:
+                                get_semantic_cache().put(semantic_scope, semantic_vector, code_cache_entry)
+
+                        summary_table = get_summary_table(exec_globals)
+
+                        final_figs = figure_tracker.figures()
                         if not final_figs:
                              fig_var = exec_globals.get("fig", None)
                              if fig_var:
                                  final_figs = [fig_var]
+                        # 從 pyplot 註冊表移除本輪圖表 (Figure 物件仍可顯示與輸出)，避免跨輪累積
+                        figure_tracker.close()
 
                     # --- [Step 5: 確保一定有摘要資訊] ---
                     if not summary_info:
@@ -723,22 +1204,26 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
                         with st.expander("🧠 查看 AI 優化後的提問邏輯 (Step 1)", expanded=False):
                             st.markdown(f"**優化導引 (Enhanced Prompt):**\n{enhanced_prompt}")
 
+                        if st.session_state.get("from_cache") == "exact":
+                            st.caption("⚡ 此分析沿用先前相同問題的快取程式碼")
+                        elif st.session_state.get("from_cache") == "semantic":
+                            st.caption("⚡ 此分析沿用先前「相似問題」的快取程式碼 (語意比對，結果可能與問題不完全相符)")
                         with st.expander("🧾 查看 AI 生成的程式碼 (最終版)", expanded=False):
                             st.code(code_to_execute, language="python")
 
+                    # 每張圖表只編碼一次預覽與一次高解析度 PNG：預覽用於畫面與歷史顯示，
+                    # 高解析度用於下載按鈕與 ZIP 報告 (以 st.image 顯示，不再讓 st.pyplot 另外編碼一次)
+                    # 先預留顯示位置並在背景編碼，與 Step 6 的洞察請求重疊進行；編碼完成的圖表隨時補上
+                    png_futures = []
+                    pending_charts = []
                     if final_figs:
-                        for i, fig in enumerate(final_figs):
-                            st.pyplot(fig)
-                            buf = io.BytesIO()
-                            fig.savefig(buf, format="png", dpi=300, bbox_inches="tight")
-                            buf.seek(0)
-                            st.download_button(
-                                f"📥 下載圖表 {i+1}",
-                                data=buf,
-                                file_name=f"羽球分析_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}.png",
-                                mime="image/png",
-                                key=f"download_new_{i}"
-                            )
+                        render_executor = get_render_executor()
+                        png_futures = [render_executor.submit(render_chart_pngs, fig) for fig in final_figs]
+                        pending_charts = [
+                            (i, st.empty(), st.empty(), png_future)
+                            for i, png_future in enumerate(png_futures)
+                        ]
+                        fill_chart_slots(pending_charts)
                     elif not execution_output:
                         st.warning("⚠️ AI 沒有輸出圖表也沒有文字輸出 (可能是資料篩選後為空，建議檢查球員名稱是否正確)。")
 
@@ -753,60 +1238,69 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
                         st.divider()
 
                     try:
-                        analysis_context_str = ""
+                        # 以 list 收集片段最後一次 join，避免反覆 += 產生中間字串
+                        context_parts = []
                         
                         # 加入執行輸出 (stdout) 到分析上下文
                         if execution_output:
-                            analysis_context_str += f"--- 程式執行輸出 (Stdout) ---\n{execution_output}\n\n"
+                            context_parts.append(f"--- 程式執行輸出 (Stdout) ---\n{execution_output}\n\n")
+
+                        if summary_table is not None:
+                            context_parts.append(f"### 結果表格 `summary`\n```csv\n{frame_to_prompt_csv(summary_table)}```\n\n")
 
                         if not summary_info:
-                            analysis_context_str += "AI 程式碼未產生任何可供分析的摘要變數。"
+                            context_parts.append("AI 程式碼未產生任何可供分析的摘要變數。")
                         else:
-                            analysis_context_str += "程式碼執行後，擷取出以下核心變數與其值：\n\n"
+                            context_parts.append("程式碼執行後，擷取出以下核心變數與其值：\n\n")
                             for name, val in summary_info.items():
-                                analysis_context_str += f"### 變數 `{name}` (型別: `{type(val).__name__}`)\n"
+                                context_parts.append(f"### 變數 `{name}` (型別: `{type(val).__name__}`)\n")
                                 if isinstance(val, (pd.DataFrame, pd.Series)):
-                                    analysis_context_str += f"```markdown\n{val.to_markdown()}\n```\n\n"
+                                    context_parts.append(f"```csv\n{frame_to_prompt_csv(val)}```\n\n")
                                 else:
-                                    analysis_context_str += f"```\n{str(val)}\n```\n\n"
+                                    context_parts.append(f"```\n{str(val)}\n```\n\n")
+                        analysis_context_str = "".join(context_parts)
                         
-                        insight_prompt = f"""
-                        你是羽球教練。問題: "{prompt}"
-                        數據:
-                        {analysis_context_str}
-                        規定:
-                        1. 若圖表含 "player_type"/"opponent_type"，必須輸出 Mapping: 1:發短球, 2:發長球, 3:長球, 4:殺球, 5:切球, 6:挑球, 7:平球, 8:網前球, 9:推撲球, 10:接殺防守, 11:接不到。
-                        2. 若圖表含 "area" (landing_area...)，必須輸出:
-| Row/Col | Col A (Left) | Col B (C-Left) | Col C (C-Right) | Col D (Right) |
-| :--- | :---: | :---: | :---: | :---: |
-| **Row 6 (Front)** | 21 | 22 | 23 | 24 |
-| **Row 5 (Front)** | 17 | 18 | 19 | 20 |
-| **Row 4 (Mid)** | 13 | 14 | 15 | 16 |
-| **Row 3 (Mid)** | 9 | 10 | 11 | 12 |
-| **Row 2 (Mid)** | 5 | 6 | 7 | 8 |
-| **Row 1 (Back)** | 1 | 2 | 3 | 4 |
-
-                        用教練口吻，基於數據精簡提供戰術洞察。說明數字背後的意義，只說事實。
-                        """
+                        insight_prompt = INSIGHT_PROMPT_TEMPLATE.format(prompt=prompt, analysis_context_str=analysis_context_str)
                         
                         
-                        messages_6 = [
-                                {"role": "system", "content": "你是一位專業羽球教練與數據戰術大師。請針對使用者問題與核心數據結果，用教練的口吻撰寫精準的戰術洞察，提供有深度的分析，不要有統計術語，需精簡回答。"},
-                                {"role": "user", "content": insight_prompt},
-                            ]
-                        insight = client.chat.completions.create(
-                            model=model_choice,
-                            messages=messages_6,
-                            temperature=0.4,
-                        )
-                        summary_text = insight.choices[0].message.content
-                        log_llm_interaction("Step 6: Insight Generation", messages_6, summary_text)
-                        st.markdown(summary_text)
+                        # 相同模型 + 相同問題與數據時沿用本 session 已生成的洞察，省去一次 LLM 往返
+                        insight_cache = st.session_state.setdefault("_insight_cache", {})
+                        insight_key = hashlib.blake2b(f"{model_choice}\x00{insight_prompt}".encode("utf-8")).hexdigest()
+                        summary_text = insight_cache.get(insight_key)
+                        if summary_text is None:
+                            messages_6 = [
+                                    {"role": "system", "content": INSIGHT_SYSTEM_PROMPT},
+                                    {"role": "user", "content": insight_prompt},
+                                ]
+                            # 以串流方式逐段顯示洞察，使用者在第一個 token 抵達時即可開始閱讀
+                            insight_stream = client.chat.completions.create(
+                                model=model_choice,
+                                messages=messages_6,
+                                temperature=0.4,
+                                stream=True,
+                            )
+                            # 節流更新：片段先累積，最多每 STREAM_REFRESH_SECONDS 秒重畫一次
+                            insight_writer = ThrottledWriter(st.empty().markdown)
+                            for chunk in insight_stream:
+                                if chunk.choices and chunk.choices[0].delta.content:
+                                    insight_writer.push(chunk.choices[0].delta.content)
+                                if pending_charts:
+                                    fill_chart_slots(pending_charts)
+                            summary_text = insight_writer.flush()
+                            log_llm_interaction("Step 6: Insight Generation", messages_6, summary_text)
+                            insight_cache[insight_key] = summary_text
+                        else:
+                            st.markdown(summary_text)
 
                     except Exception as e:
                         summary_text = f"*(無法生成洞察: {e})*"
                         st.warning(summary_text)
 
+                    # 洞察完成後等待其餘圖表編碼完成並補上；編碼結果同時存入歷史訊息
+                    fill_chart_slots(pending_charts, wait=True)
+                    figure_pngs = [png_future.result() for png_future in png_futures]
+
+
                     # --- [Step 7: 儲存至歷史] ---
                     code_block_for_history = f"```python\n{code_to_execute}\n```" if code_to_execute else ""
                     final_content_for_history = (
@@ -816,10 +1310,15 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
                         f"{summary_text}"
                     )
                     
-                    st.session_state.messages.append({
+                    append_message({
                         "role": "assistant",
                         "content": final_content_for_history.strip(),
-                        "figures": final_figs,
+                        # session_state 只保留檔案路徑，不長期持有 Figure 物件
+                        "figure_paths": [save_chart_png(st.session_state.session_id, export_png) for _, export_png in figure_pngs],
+                        "preview_paths": [
+                            save_chart_png(st.session_state.session_id, preview_png, suffix="_preview")
+                            for preview_png, _ in figure_pngs
+                        ],
                         "enhanced_prompt": enhanced_prompt # [修改點]：儲存優化後的提問邏輯
                     })
 
@@ -828,6 +1327,6 @@ if prompt := st.chat_input("請輸入你的數據分析問題..."):
                 except Exception as e:
                     status.update(label="分析失敗", state="error")
                     st.error(f"❌ 錯誤: {e}")
-                    st.session_state.messages.append({
-                        "role": "assistant", "content": str(e), "figure": None
+                    append_message({
+                        "role": "assistant", "content": str(e), "figure_paths": []
                     })
\ No newline at end of file
@@ -2,13 +2,53 @@
 AI Client 初始化模組
 AI client initialization for different API providers
 """
+import json
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import httpx
 import openai
+import streamlit as st
+
+from utils.disk_cache import LLM_CACHE_PATH, LLM_CACHE_TTL_SECONDS, make_cache_key, cache_get, cache_set
+
+# LLM 回覆中的 JSON 程式碼區塊 (```json ... ``` 或 ``` ... ```)
+_JSON_RE = re.compile(r"```(?:json)?\s*\n?(.*?)```", re.DOTALL)
+
+# JSON 解析/序列化：優先使用 orjson (C 實作，較快)，未安裝時退回標準函式庫
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _cache_key_json(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _cache_key_json(obj):
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True)
+
+# 回應快取的記憶體層：命中時連磁碟 (shelve) 都不必開啟
+_MEMORY_CACHE_SIZE = 256
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+# 進行中的請求 (key -> Future)：同時送出的相同請求 (如重複送出、多個 session 問同一題) 共用一次 API 呼叫
+_inflight = {}
 
+# 連線池設定：rerun 之間沿用同一個 client，保持 keep-alive 連線可省去重複的 TCP/TLS 握手
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
 
+
+@st.cache_resource
 def initialize_client(api_mode: str, api_key: str):
     """
     根據模式和金鑰初始化 AI client
 
+    以 (api_mode, api_key) 為 key 快取，重新執行時沿用同一個 client 與其連線池。
+
     Args:
         api_mode: API 模式 ("Gemini", "OpenAI 官方", "交大伺服器")
         api_key: API 金鑰
@@ -20,15 +60,92 @@ def initialize_client(api_mode: str, api_key: str):
         >>> client = initialize_client("Gemini", "your_api_key")
         >>> client = initialize_client("OpenAI 官方", "your_api_key")
     """
+    # DefaultHttpxClient 保留 SDK 預設的 timeout 與轉址設定，只調整連線池大小
+    http_client = openai.DefaultHttpxClient(limits=HTTP_LIMITS)
+
     if api_mode == "Gemini":
         return openai.OpenAI(
             api_key=api_key,
-            base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
+            base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+            http_client=http_client,
         )
     elif api_mode == "交大伺服器":
         return openai.OpenAI(
             api_key=api_key,
-            base_url="https://llm.nycu-adsl.cc"
+            base_url="https://llm.nycu-adsl.cc",
+            http_client=http_client,
         )
     else:  # OpenAI 官方
-        return openai.OpenAI(api_key=api_key)
+        return openai.OpenAI(api_key=api_key, http_client=http_client)
+
+
+def cached_chat_completion(client, model, messages, temperature):
+    """
+    呼叫 chat completion 並將回應快取於磁碟，相同請求直接回傳先前的回應
+
+    適用於低 temperature、結果可重複使用的步驟 (問題澄清、問題轉化、邏輯檢查)。
+    先查 process 內的 LRU 記憶體快取，再查磁碟快取，都沒有才呼叫 API；
+    相同請求正在進行中時等待其結果，不重複呼叫。
+
+    Args:
+        client: OpenAI client
+        model: 模型名稱
+        messages: OpenAI 格式的訊息列表
+        temperature: 取樣溫度
+
+    Returns:
+        str: 回應文字
+    """
+    key = make_cache_key(model, temperature, _cache_key_json(messages))
+    with _memory_lock:
+        content = _memory_cache.get(key)
+        if content is not None:
+            _memory_cache.move_to_end(key)
+            return content
+        future = _inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _inflight[key] = Future()
+
+    # 已有相同請求進行中：等待其結果 (成功或例外) 而不重複呼叫 API
+    if not is_owner:
+        return future.result()
+
+    try:
+        content = cache_get(LLM_CACHE_PATH, key, ttl=LLM_CACHE_TTL_SECONDS)
+        if content is None:
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+            )
+            content = response.choices[0].message.content
+            cache_set(LLM_CACHE_PATH, key, content)
+    except BaseException as e:
+        with _memory_lock:
+            _inflight.pop(key, None)
+        future.set_exception(e)
+        raise
+
+    with _memory_lock:
+        _memory_cache[key] = content
+        if len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+        _inflight.pop(key, None)
+    future.set_result(content)
+    return content
+
+
+def parse_json_response(text):
+    """
+    解析 LLM 回覆中的 JSON (若包在 Markdown 程式碼區塊中則取出區塊內容)
+
+    Returns:
+        解析後的 JSON 物件
+
+    Raises:
+        ValueError: 內容不是合法的 JSON (json/orjson 的 JSONDecodeError 皆為其子類別)
+    """
+    match = _JSON_RE.search(text)
+    json_str = match.group(1).strip() if match else text
+    return _json_loads(json_str)
@@ -0,0 +1,321 @@
+"""
+AI 生成程式碼執行相關函數
+Helpers for running AI-generated analysis code and summarizing its results
+"""
+import io
+import numbers
+import re
+import sys
+import threading
+from collections.abc import Sized
+from contextlib import contextmanager
+from functools import lru_cache
+
+import pandas as pd
+
+# AI 回覆中的 Python 程式碼區塊
+_CODE_RE = re.compile(r"```python\s*\n(.*?)```", re.DOTALL)
+
+# 執行環境中不需回報給 LLM 的名稱 (預先注入的模組與原始資料)
+_IGNORE = frozenset(['df', 'pd', 'st', 'platform', 'io', 'fig', 'np', 'plt', 'sns'])
+
+
+def _summarize_frame(val):
+    # 強制讓 LLM 知道資料是空的；資料太大時只告訴 LLM 大小，不傳全部內容
+    if val.empty:
+        return "⚠️ Empty DataFrame/Series (0 rows)"
+    return f"DataFrame/Series with {len(val)} rows"
+
+
+def _identity(val):
+    return val
+
+
+_SKIP = object()
+
+
+def _summarize_sized(val):
+    # 0 維 ndarray 等物件的 len() 會拋出例外，略過該變數而不中斷整個分析
+    try:
+        return val if len(val) < 20 else _SKIP
+    except Exception:
+        return _SKIP
+
+
+# 以型別名稱分派摘要方式 (單次 dict 查詢取代 isinstance 判斷鏈)
+_SUMMARIZERS = {
+    "int": _identity,
+    "float": _identity,
+    "str": _identity,
+    "bool": _identity,
+    "int64": _identity,
+    "float64": _identity,
+    "DataFrame": _summarize_frame,
+    "Series": _summarize_frame,
+    "list": _summarize_sized,
+    "tuple": _summarize_sized,
+    "dict": _summarize_sized,
+    "set": _summarize_sized,
+    "ndarray": _summarize_sized,
+}
+
+
+@lru_cache(maxsize=256)
+def _summarizer_for(cls):
+    """
+    找出型別對應的摘要方式
+
+    先依 MRO 查型別名稱 (Counter/defaultdict/OrderedDict 等子類別沿用父類別的方式)，
+    查不到時再以 isinstance 判斷：數值 (含 numpy scalar) 原樣回報，有長度的容器 (range、pd.Index 等) 依長度決定。
+
+    Returns:
+        callable or None: 摘要函數，None 代表不回報此變數
+    """
+    for base in cls.__mro__:
+        summarize = _SUMMARIZERS.get(base.__name__)
+        if summarize is not None:
+            return summarize
+    if issubclass(cls, numbers.Number):
+        return _identity
+    if issubclass(cls, Sized):
+        return _summarize_sized
+    return None
+
+
+def extract_code(text):
+    """
+    從 AI 回覆中取出 Python 程式碼 (單次掃描，多個區塊依序合併)
+
+    Returns:
+        str or None: 程式碼，若回覆中沒有 ```python 區塊則回傳 None
+    """
+    blocks = _CODE_RE.findall(text)
+    if not blocks:
+        return None
+    return "\n\n".join(block.strip() for block in blocks)
+
+
+def strip_code_blocks(text):
+    """移除回覆中的 Python 程式碼區塊，只保留文字內容"""
+    return _CODE_RE.sub("", text).strip()
+
+
+@lru_cache(maxsize=128)
+def compile_code(source):
+    """
+    將 AI 程式碼編譯為 code object，相同原始碼 (重試、邏輯修正失敗後重跑、程式碼快取) 只編譯一次
+
+    Raises:
+        SyntaxError: 程式碼語法錯誤 (不會被快取)
+    """
+    return compile(source, "<ai_code>", "exec")
+
+
+def summarize_namespace(exec_globals):
+    """
+    從執行後的環境變數擷取可供 LLM 檢查的摘要
+
+    Args:
+        exec_globals: exec() 使用的 globals dict
+
+    Returns:
+        dict: 變數名稱 -> 摘要值
+    """
+    # 單次走訪：每個變數只查一次型別分派 (依型別快取)，不再另建中間 dict 過濾 _SKIP
+    summary_info = {}
+    for name, val in exec_globals.items():
+        if name in _IGNORE or name.startswith('_'):
+            continue
+        summarize = _summarizer_for(type(val))
+        if summarize is None:
+            continue
+        summarized = summarize(val)
+        if summarized is not _SKIP:
+            summary_info[name] = summarized
+    return summary_info
+
+
+def has_empty_frames(exec_globals):
+    """檢查 AI 程式碼產生的 DataFrame/Series 中是否有空表格 (通常代表篩選條件有誤)"""
+    return any(
+        isinstance(val, (pd.DataFrame, pd.Series)) and val.empty
+        for name, val in exec_globals.items()
+        if name not in _IGNORE and not name.startswith('_')
+    )
+
+
+# 系統指令要求 AI 將最終結果表格指定給此變數名稱
+SUMMARY_VAR = "summary"
+
+
+def get_summary_table(exec_globals):
+    """
+    取得 AI 程式碼產出的結果表格
+
+    優先直接讀取約定的 `summary` 變數；舊程式碼 (如程式碼快取) 未依約定時，
+    才退回掃描第一個非空的 DataFrame/Series。
+
+    Args:
+        exec_globals: exec() 使用的 globals dict
+
+    Returns:
+        DataFrame/Series or None
+    """
+    val = exec_globals.get(SUMMARY_VAR)
+    if isinstance(val, (pd.DataFrame, pd.Series)):
+        return val
+    return next(
+        (
+            val for name, val in exec_globals.items()
+            if not name.startswith('_') and name not in _IGNORE
+            and isinstance(val, (pd.DataFrame, pd.Series)) and not val.empty
+        ),
+        None,
+    )
+
+
+# 超過此欄數的表格只傳前 MAX_PROMPT_COLUMNS 欄
+MAX_PROMPT_COLUMNS = 20
+
+# 過寬表格傳給 LLM 的筆數
+WIDE_TABLE_ROWS = 10
+
+
+def frame_to_prompt_csv(val, max_rows=50):
+    """
+    將 DataFrame/Series 轉為 CSV 文字供 LLM 閱讀，最多保留前 max_rows 筆
+
+    CSV 不需要 tabulate 逐欄計算對齊寬度，token 數也比 Markdown 表格少。
+    過寬的表格只傳前 MAX_PROMPT_COLUMNS 欄的前 WIDE_TABLE_ROWS 筆並註明略去的欄數；
+    超過 max_rows 的純數值表格改傳 describe() 統計與前 10 筆。
+
+    Args:
+        val: DataFrame 或 Series
+        max_rows: 最多保留的筆數
+
+    Returns:
+        str: CSV 文字 (Series 另附 describe() 統計)
+    """
+    if isinstance(val, pd.DataFrame):
+        if val.shape[1] > MAX_PROMPT_COLUMNS:
+            omitted = val.shape[1] - MAX_PROMPT_COLUMNS
+            return (
+                f"(wide table, {len(val)} rows x {val.shape[1]} columns: first {min(len(val), WIDE_TABLE_ROWS)} rows "
+                f"of the first {MAX_PROMPT_COLUMNS} columns, {omitted} columns omitted)\n"
+                + val.iloc[:WIDE_TABLE_ROWS, :MAX_PROMPT_COLUMNS].to_csv()
+            )
+        if len(val) > max_rows and not val.empty and val.select_dtypes(include="number").shape[1] == val.shape[1]:
+            return (
+                f"(numeric table, {len(val)} rows: describe + first 10 rows)\n"
+                + val.describe().to_csv()
+                + "\n"
+                + val.head(10).to_csv()
+            )
+
+    if len(val) > max_rows:
+        table = f"(showing {max_rows}/{len(val)} rows)\n" + val.head(max_rows).to_csv()
+    else:
+        table = val.to_csv()
+
+    if isinstance(val, pd.Series):
+        table += "\n" + val.describe().to_csv()
+    return table
+
+
+class _ThreadRoutedStdout:
+    """
+    依執行緒分流的 sys.stdout
+
+    有設定擷取緩衝的執行緒寫入自己的緩衝，其他執行緒 (伺服器、其他 session) 照常寫入原本的 stdout。
+    取代 redirect_stdout：後者會替換整個 process 的 sys.stdout，執行中 (或逾時仍未結束) 的 AI 程式碼
+    會把所有執行緒的輸出都收進自己的緩衝。
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, "buffer", None) or self._default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._default, name)
+
+
+_stdout_lock = threading.Lock()
+
+
+@contextmanager
+def capture_stdout():
+    """
+    擷取目前執行緒寫入 sys.stdout 的內容 (不影響其他執行緒)
+
+    Yields:
+        io.StringIO: 擷取到的輸出
+    """
+    with _stdout_lock:
+        if not isinstance(sys.stdout, _ThreadRoutedStdout):
+            sys.stdout = _ThreadRoutedStdout(sys.stdout)
+        router = sys.stdout
+
+    buffer = io.StringIO()
+    router._local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        router._local.buffer = None
+
+
+class FigureTracker:
+    """
+    追蹤單次執行新開啟的 Matplotlib 圖表
+
+    只關閉自己開啟的圖表，而不是以 plt.close('all') 或 Gcf.destroy_all() 清空整個 pyplot 註冊表
+    (註冊表為整個 process 共用，其他 session 的圖表也在其中)。
+    """
+
+    def __init__(self, plt):
+        self.plt = plt
+        self.fignums = []
+        self._figures = []
+
+    def close(self):
+        """關閉上一次執行開啟的圖表 (已關閉的 Figure 物件仍可 savefig / 顯示)"""
+        for num in self.fignums:
+            self.plt.close(num)
+        self.fignums = []
+        self._figures = []
+
+    @contextmanager
+    def track(self):
+        """關閉上一次的圖表後，記錄區塊內新開啟的圖表"""
+        from matplotlib._pylab_helpers import Gcf
+
+        self.close()
+        before = set(Gcf.figs)
+        try:
+            yield self
+        finally:
+            # 直接由 figure manager 取得 Figure 物件，不再透過 plt.figure(num) 查詢 (會切換目前作用中的圖表)
+            managers = [manager for num, manager in Gcf.figs.items() if num not in before]
+            self.fignums = [manager.num for manager in managers]
+            self._figures = [manager.canvas.figure for manager in managers]
+
+    def renew(self):
+        """
+        關閉本 tracker 記錄的圖表，回傳新的 tracker 供下一次執行使用
+
+        每次執行使用獨立的 tracker，逾時仍在背景執行的舊程式碼結束時不會覆寫新一次執行的紀錄。
+        """
+        self.close()
+        return FigureTracker(self.plt)
+
+    def figures(self):
+        """回傳最近一次執行開啟的 Figure 物件"""
+        return list(self._figures)
@@ -3,21 +3,74 @@
 Data loading utilities for BadmintonAI
 """
 import os
+import re
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import json
 import io
 import streamlit as st
-import numpy as np
 
 # 檔案路徑常數
 DATA_FILE = "processed_new_3.csv"
 COLUMN_DEFINITION_FILE = "column_definition.json"
 
 
+def _nan_arrow_string_dtype():
+    """
+    取得以 NaN 表示缺值的 PyArrow 字串型別
+
+    必須維持 NaN 語意 (比較結果為 numpy bool、缺值比較為 False)，
+    不能用 pd.NA 語意的 StringDtype("pyarrow")：`df['player'] == df['getpoint_player']`
+    會變成含 NA 的 nullable boolean，改變 AI 程式碼的篩選與比例計算結果。
+
+    Returns:
+        pd.StringDtype or None: pandas 2.3+ 為 na_value=np.nan，2.1~2.2 為 "pyarrow_numpy"；
+        版本不支援或未安裝 pyarrow 時回傳 None
+    """
+    try:
+        return pd.StringDtype("pyarrow", na_value=np.nan)
+    except TypeError:
+        pass  # pandas < 2.3 沒有 na_value 參數
+    except ImportError:
+        return None
+    try:
+        return pd.StringDtype("pyarrow_numpy")
+    except (ValueError, ImportError):
+        return None
+
+
+def to_arrow_strings(df):
+    """
+    將文字欄位 (object dtype 且只含字串) 轉為 PyArrow 字串型別 (NaN 缺值語意)
+
+    AI 程式碼最常對球員、球種等文字欄位做 groupby / isin / value_counts，
+    Arrow 字串欄位在這些操作上比 Python 物件欄位快；數值欄位維持 numpy 型別不變。
+    無法取得 NaN 語意的 Arrow 字串型別時原樣回傳。
+
+    Args:
+        df: 原始 DataFrame
+
+    Returns:
+        pd.DataFrame: 轉換後的 DataFrame
+    """
+    arrow_string = _nan_arrow_string_dtype()
+    if arrow_string is None:
+        return df
+
+    string_cols = [
+        col for col in df.select_dtypes(include="object").columns
+        if pd.api.types.infer_dtype(df[col], skipna=True) == "string"
+    ]
+    if not string_cols:
+        return df
+    return df.astype({col: arrow_string for col in string_cols})
+
+
 @st.cache_data
 def load_data(filepath):
     """
-    載入 CSV 數據並快取
+    載入 CSV 數據並快取 (文字欄位轉為 PyArrow 字串型別)
 
     Args:
         filepath: CSV 檔案路徑
@@ -26,7 +79,7 @@ def load_data(filepath):
         pd.DataFrame or None: 載入的 DataFrame，若檔案不存在則回傳 None
     """
     if os.path.exists(filepath):
-        return pd.read_csv(filepath)
+        return to_arrow_strings(pd.read_csv(filepath))
     return None
 
 
@@ -54,7 +107,8 @@ def get_data_schema(df):
         schema_parts.append(col_header)
 
         # 1. Numeric Range
-        if np.issubdtype(dtype, np.number):
+        # Arrow 字串等 extension dtype 無法交給 np.issubdtype 判斷
+        if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
             col_min = series.min(skipna=True)
             col_max = series.max(skipna=True)
             schema_parts.append(f"- Range: {col_min} ~ {col_max}")
@@ -144,10 +198,16 @@ def load_column_definitions(filepath):
         return "錯誤：'column_definition.json' 檔案格式錯誤。"
 
 
+@st.cache_resource(show_spinner="載入資料中...")
 def load_all_data():
     """
     載入所有資料（DataFrame、Schema、欄位定義）
 
+    結果以 st.cache_resource 快取，重新執行 (rerun) 時直接取用同一份物件，
+    不再重複讀檔，也不像 st.cache_data 每次反序列化出新的 DataFrame。
+    回傳的 df 為共用物件，呼叫端需在 pandas Copy-on-Write 模式下使用並勿原地修改；
+    上傳新資料後以 load_all_data.clear() 清除。
+
     Returns:
         tuple: (df, data_schema_info, column_definitions_info)
     """
@@ -200,3 +260,84 @@ def load_all_data():
         column_definitions_info = load_column_definitions(COLUMN_DEFINITION_FILE)
 
     return df, data_schema_info, column_definitions_info
+
+
+@st.cache_resource(show_spinner=False)
+def load_player_matches():
+    """
+    建立「球員名稱 -> 出賽 match_id 集合」索引 (player 與 opponent 欄位皆計入)
+
+    與 load_all_data 共用同一份 df，上傳新資料後需一併以 load_player_matches.clear() 清除。
+
+    Returns:
+        dict: {球員名稱: set(match_id)}，資料缺少必要欄位時回傳空 dict
+    """
+    df, _, _ = load_all_data()
+    if df is None or df.empty or "match_id" not in df.columns:
+        return {}
+
+    player_matches = {}
+    for col in ("player", "opponent"):
+        if col not in df.columns:
+            continue
+        for name, match_ids in df.groupby(col)["match_id"].unique().items():
+            player_matches.setdefault(str(name), set()).update(match_ids)
+    return player_matches
+
+
+@lru_cache(maxsize=1024)
+def _player_name_pattern(name):
+    """
+    建立比對球員名稱的 regex (不分大小寫)
+
+    完整名稱或任一個英文名字片段 (如 "CHOU Tien Chen" 的 "chou"、"Kento MOMOTA" 的 "momota")
+    皆視為提到該球員；英文片段前後不可緊接英文字母，避免 "li" 比對到 "split"。
+    """
+    alternatives = [re.escape(name.lower())]
+    alternatives += [
+        rf"(?<![a-z]){re.escape(token)}(?![a-z])"
+        for token in name.lower().split()
+        if len(token) >= 2 and token.isascii()
+    ]
+    return re.compile("|".join(alternatives))
+
+
+def find_mentioned_players(text, player_matches):
+    """
+    找出文字中提到的球員 (不分大小寫，可只寫姓或名)
+
+    Args:
+        text: 使用者問題
+        player_matches: load_player_matches() 的結果
+
+    Returns:
+        list: 提到的球員名稱
+    """
+    lowered = text.lower()
+    return [name for name in player_matches if name and _player_name_pattern(name).search(lowered)]
+
+
+def scope_to_players(df, text, player_matches):
+    """
+    只保留問題中提到的球員有出賽的比賽，縮小 AI 程式碼處理的資料量
+
+    以整場比賽為單位篩選 (不是只留該球員的擊球)，match -> set -> rally 結構完整，
+    對手的擊球與 shift() 前後拍分析不受影響。
+
+    Args:
+        df: 完整資料
+        text: 使用者問題 (可含強化後的問題)
+        player_matches: load_player_matches() 的結果
+
+    Returns:
+        pd.DataFrame: 篩選後的資料；未提到任何球員或已涵蓋全部比賽時回傳原 df
+    """
+    mentioned = find_mentioned_players(text, player_matches)
+    if not mentioned:
+        return df
+
+    match_ids = set().union(*(player_matches[name] for name in mentioned))
+    all_match_ids = set().union(*player_matches.values())
+    if len(match_ids) >= len(all_match_ids):
+        return df
+    return df[df["match_id"].isin(match_ids)]
@@ -0,0 +1,87 @@
+"""
+磁碟快取相關函數
+Small shelve-backed caches that survive app restarts
+"""
+import dbm
+import hashlib
+import logging
+import shelve
+import threading
+import time
+
+log = logging.getLogger("badminton_ai")
+
+# 已通過邏輯檢查的分析程式碼快取 (key: 模型 + 資料版本 + 正規化後的問題)
+CODE_CACHE_PATH = ".ai_code_cache"
+
+# LLM 回應快取 (key: 模型 + temperature + 完整訊息內容)
+LLM_CACHE_PATH = ".llm_cache"
+# LLM 回應快取的有效期限 (秒)；模型版本更新後舊回應會自然過期
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# shelve 不支援多執行緒同時寫入，同一 process 內以 lock 序列化存取
+_lock = threading.Lock()
+
+
+def make_cache_key(*parts):
+    """
+    將多個字串 / bytes 組合成 SHA256 快取 key
+
+    Returns:
+        str: 十六進位 hash 字串
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        # bytes (如 orjson 序列化結果) 直接寫入，其他型別轉為 UTF-8 字串
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def normalize_prompt(prompt):
+    """將問題轉小寫並合併多餘空白，讓格式差異不影響快取命中"""
+    return " ".join(prompt.lower().split())
+
+
+def cache_get(path, key, ttl=None):
+    """
+    讀取快取
+
+    Args:
+        path: shelve 檔案路徑
+        key: 快取 key
+        ttl: 有效秒數，None 表示永不過期
+
+    Returns:
+        快取值，若不存在或已過期則回傳 None
+    """
+    with _lock:
+        try:
+            with shelve.open(path, flag="r") as db:
+                entry = db.get(key)
+        except dbm.error:
+            # 快取檔尚未建立
+            return None
+
+    # 舊格式 (未記錄寫入時間) 的項目視為不存在，下次寫入時覆蓋
+    if not isinstance(entry, tuple) or len(entry) != 2:
+        return None
+    stored_at, value = entry
+    if ttl is not None and time.time() - stored_at > ttl:
+        return None
+    return value
+
+
+def cache_set(path, key, value):
+    """
+    寫入快取 (連同寫入時間，供 cache_get 判斷是否過期)
+
+    快取寫入失敗 (唯讀檔案系統、檔案被其他 process 鎖定、磁碟已滿) 只記錄警告，
+    不影響已完成的分析或 LLM 呼叫。
+    """
+    with _lock:
+        try:
+            with shelve.open(path) as db:
+                db[key] = (time.time(), value)
+        except (OSError, dbm.error) as e:
+            log.warning("Cache write to %s failed: %s", path, e)
@@ -0,0 +1,118 @@
+"""
+語意相似問題快取
+Embedding-based lookup that reuses analysis code for near-duplicate questions
+"""
+import re
+import threading
+
+import numpy as np
+import streamlit as st
+
+# 問題向量使用的 embedding 模型
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# cosine 相似度達此門檻才視為同一個問題
+SIMILARITY_THRESHOLD = 0.92
+
+# 記憶體中最多保留的問題數 (超過時淘汰最舊的)
+MAX_ENTRIES = 512
+
+_NUMBER_RE = re.compile(r"\d+")
+
+# 英文名字樣式的片段 (資料中的球員名稱為英文)
+_LATIN_NAME_RE = re.compile(r"[A-Za-z]{2,}")
+
+
+def question_entities(prompt, players):
+    """
+    取出問題中的具體條件 (提到的球員與數字)
+
+    語意相近但條件不同的問題 (如不同球員、不同局數) 不可共用程式碼，
+    這些條件需完全相同才會比對相似度。
+
+    Args:
+        prompt: 使用者問題
+        players: 問題中提到的球員名稱
+
+    Returns:
+        tuple: 可 hash 的條件組合
+    """
+    return tuple(sorted(players)), tuple(_NUMBER_RE.findall(prompt))
+
+
+def has_unresolved_names(prompt, players):
+    """
+    問題含英文名字樣式的片段，卻沒有比對到任何球員
+
+    這種問題很可能提到資料中沒有 (或拼法不同) 的球員，條件無法確定，不應以語意相似度沿用其他問題的程式碼。
+    """
+    return not players and _LATIN_NAME_RE.search(prompt) is not None
+
+
+def embed_text(client, text):
+    """
+    取得文字的正規化 embedding 向量
+
+    Returns:
+        np.ndarray: L2 正規化後的 float32 向量 (內積即 cosine 相似度)
+    """
+    response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class SemanticCache:
+    """
+    以 embedding 相似度查詢的問題快取
+
+    scope (模型 + 資料版本 + 問題條件) 必須完全相同，才在同一組向量中以內積找出最相似的問題。
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries=MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}  # scope -> (向量矩陣, 值列表)
+
+    def get(self, scope, vector):
+        """
+        Returns:
+            快取值，找不到相似度達門檻的問題時回傳 None
+        """
+        with self._lock:
+            entry = self._entries.get(scope)
+            if entry is None:
+                return None
+            matrix, values = entry
+            scores = matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            return values[best]
+
+    def put(self, scope, vector, value):
+        """加入一筆快取"""
+        with self._lock:
+            matrix, values = self._entries.get(scope, (np.empty((0, vector.shape[0]), dtype=np.float32), []))
+            self._entries[scope] = (np.vstack([matrix, vector]), values + [value])
+            self._evict()
+
+    def _evict(self):
+        # 總數超過上限時，從最早建立的 scope 開始丟棄最舊的項目
+        total = sum(len(values) for _, values in self._entries.values())
+        for scope in list(self._entries):
+            if total <= self.max_entries:
+                break
+            matrix, values = self._entries[scope]
+            drop = min(len(values), total - self.max_entries)
+            total -= drop
+            if drop == len(values):
+                del self._entries[scope]
+            else:
+                self._entries[scope] = (matrix[drop:], values[drop:])
+
+
+@st.cache_resource
+def get_semantic_cache():
+    """整個 process 共用一份語意快取 (重新執行時保留)"""
+    return SemanticCache()
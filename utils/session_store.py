@@ -0,0 +1,69 @@
+"""
+對話圖表檔案儲存相關函數
+Persist chart PNGs to disk so session_state only keeps file paths
+"""
+import os
+import re
+import shutil
+import time
+
+# 每個瀏覽器 session 一個子目錄: data/sessions/{session_id}/chart_{n}.png
+SESSION_DIR = os.path.join("data", "sessions")
+
+# 超過此秒數未更新的 session 目錄視為閒置並刪除
+SESSION_TTL_SECONDS = 60 * 60
+
+
+def save_chart_png(session_id, png_bytes, suffix=""):
+    """
+    將圖表 PNG 寫入 session 目錄
+
+    Args:
+        session_id: session 識別字串
+        png_bytes: 已編碼的 PNG 資料
+        suffix: 檔名後綴 (如預覽圖 "_preview")，同一後綴的檔案各自編號
+
+    Returns:
+        str: 圖表檔案路徑
+    """
+    session_path = os.path.join(SESSION_DIR, session_id)
+    os.makedirs(session_path, exist_ok=True)
+    pattern = re.compile(rf"chart_\d+{re.escape(suffix)}\.png")
+    chart_number = sum(1 for name in os.listdir(session_path) if pattern.fullmatch(name)) + 1
+    path = os.path.join(session_path, f"chart_{chart_number}{suffix}.png")
+    with open(path, "wb") as f:
+        f.write(png_bytes)
+    return path
+
+
+def read_chart_png(path):
+    """
+    讀取圖表 PNG
+
+    Returns:
+        bytes or None: 檔案已被清除時回傳 None
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def cleanup_expired_sessions(ttl_seconds=SESSION_TTL_SECONDS):
+    """
+    刪除超過 ttl_seconds 未更新的 session 目錄
+
+    Returns:
+        int: 刪除的目錄數
+    """
+    if not os.path.isdir(SESSION_DIR):
+        return 0
+
+    cutoff = time.time() - ttl_seconds
+    removed = 0
+    for entry in os.scandir(SESSION_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
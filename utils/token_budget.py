@@ -0,0 +1,125 @@
+"""
+Token 預算相關函數
+Prompt-length pre-flight checks before sending requests to the LLM
+"""
+import logging
+from functools import lru_cache
+
+log = logging.getLogger("badminton_ai")
+
+# 各模型的 context window (tokens)，未列出的模型使用 DEFAULT_CONTEXT_WINDOW
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gemini-2.0-flash": 1048576,
+    "gemini-1.5-pro": 2097152,
+    "gemini-1.5-flash": 1048576,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+
+# 預留給模型輸出的 token 數
+OUTPUT_RESERVE = 8000
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    """
+    取得模型對應的 tiktoken 編碼器，Gemini 等非 OpenAI 模型以 o200k_base 近似
+
+    Returns:
+        tiktoken.Encoding or None: 未安裝 tiktoken 或無法載入編碼檔時回傳 None
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # 第一次使用時需下載 BPE 檔，離線環境會失敗；結果 (None) 由 lru_cache 保留，不會每輪重試
+        log.warning("tiktoken encoding unavailable, falling back to character count: %s", e)
+        return None
+
+
+def count_tokens(text, model):
+    """
+    估算文字的 token 數
+
+    Args:
+        text: 要估算的文字
+        model: 模型名稱
+
+    Returns:
+        int: token 數 (無 tiktoken 時以字元數保守估計，中文約一字一 token)
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def get_token_budget(model):
+    """回傳模型可用於輸入訊息的 token 上限"""
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) - OUTPUT_RESERVE
+
+
+@lru_cache(maxsize=32)
+def _count_prompt_tokens(text, model):
+    # system prompt 長且每次呼叫幾乎相同 (Step 3 重試時每輪都會修剪)，只在內容改變時重新編碼
+    return count_tokens(text, model)
+
+
+def trim_messages(messages, model, pinned=()):
+    """
+    由最舊的歷史訊息開始移除，直到總 token 數符合模型預算
+
+    第一則 (system)、最後一則 (目前問題或錯誤回饋) 與 pinned 中的訊息 (如本題的任務描述) 一律保留，
+    其餘訊息依時間由舊到新移除。
+
+    Args:
+        messages: OpenAI 格式的訊息列表
+        model: 模型名稱
+        pinned: 需保留的訊息 (以物件身分比對，即加入列表時的同一個 dict)
+
+    Returns:
+        list: 修剪後的新訊息列表 (未超出預算時回傳原列表)
+    """
+    if not messages:
+        return messages
+    budget = get_token_budget(model)
+    token_counts = [_count_prompt_tokens(messages[0].get("content", ""), model)]
+    token_counts += [count_tokens(m.get("content", ""), model) for m in messages[1:]]
+    total = sum(token_counts)
+    if total <= budget:
+        return messages
+
+    last = len(messages) - 1
+    keep = [True] * len(messages)
+    for i in range(1, last):
+        if total <= budget:
+            break
+        if any(messages[i] is p for p in pinned):
+            continue
+        keep[i] = False
+        total -= token_counts[i]
+    return [m for m, kept in zip(messages, keep) if kept]
+
+
+def truncate_text(text, max_chars):
+    """
+    將文字截斷至 max_chars 個字元 (超過時結尾加上省略標記)
+
+    Args:
+        text: 原始文字
+        max_chars: 保留的最大字元數
+
+    Returns:
+        str: 截斷後的文字
+    """
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + " …(略)"